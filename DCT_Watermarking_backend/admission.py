@@ -0,0 +1,415 @@
+import math
+import struct
+import threading
+import time
+
+import cv2
+
+from dct_pairwise import BLOCK_SIZE
+from quality_metrics import SSIM_CHUNK_BLOCKS
+
+# --- ค่าประมาณต้นทุน (วัดจาก pipeline ของ app.py บนภาพ 6-24 ล้าน pixel) ---
+# หน่วยความจำ: bytes ต่อ pixel ของภาพที่ pad แล้ว
+EMBED_PIXEL_BYTES = 2      # Y ที่ pad + ผลฝัง (SSIM ดึงหน้าต่างจากภาพโดยตรง ไม่ pad ซ้ำ)
+EXTRACT_PIXEL_BYTES = 1    # Y ที่ pad
+AUTOTUNE_PIXEL_BYTES = 3   # ภาพที่ฝังลอง + JPEG ที่ถูกโจมตี + buffer ของ encoder
+COLOR_PIXEL_BYTES = 3      # ภาพ YCrCb ของภาพสี
+BLOCK_BYTES = 1200         # array float32 ชั่วคราวของ DCT/IDCT ต่อบล็อกที่ใช้
+SSIM_BLOCK_BYTES = 48 * 1024 # หน่วยความจำต่อบล็อกใน chunk ของ SSIM (Gaussian)
+
+# CPU: วินาทีต่อ pixel / ต่อบล็อก (ใช้คำนวณ Retry-After)
+EMBED_PIXEL_SECONDS = 100e-9   # decode + YCrCb + pad + encode PNG
+EXTRACT_PIXEL_SECONDS = 20e-9
+AUTOTUNE_PIXEL_SECONDS = 30e-9
+EMBED_BLOCK_SECONDS = 55e-6    # DCT/IDCT + SSIM ของบล็อกที่ถูกฝัง
+EXTRACT_BLOCK_SECONDS = 2e-6
+
+# ย่อภาพตอน decode ได้เฉพาะสเกลที่ OpenCV รองรับ (JPEG ย่อระหว่าง decode ได้จริง)
+REDUCED_SCALES = (2, 4, 8)
+_REDUCED_FLAGS = {
+    (1, 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (1, 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    (1, 8): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    (3, 2): cv2.IMREAD_REDUCED_COLOR_2,
+    (3, 4): cv2.IMREAD_REDUCED_COLOR_4,
+    (3, 8): cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+_JP2_SIGNATURE = b"\x00\x00\x00\x0cjP  \r\n\x87\n"
+_AVIF_BRANDS = {b"avif", b"avis"}
+_HEIF_BRANDS = {b"avif", b"avis", b"heic", b"heix", b"mif1", b"msf1"}
+MAX_HEADER_BOX_BYTES = 1024 * 1024 # อ่าน box ที่เก็บขนาดภาพ (meta/jp2h) ไม่เกินนี้
+
+
+class AdmissionRejected(Exception):
+    """คำขอถูกปฏิเสธ: status คือ HTTP status, retry_after คือวินาทีที่ควรลองใหม่ (ถ้ามี)"""
+
+    def __init__(self, message, status, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+# --- อ่านขนาดภาพจาก header (ไม่ decode ทั้งภาพ) ---
+def _jpeg_header(f):
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff": # fill byte
+            marker = f.read(1)
+        if not marker:
+            return None
+        code = marker[0]
+        if code == 0x01 or 0xD0 <= code <= 0xD9: # marker ที่ไม่มีความยาว
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        if code in _JPEG_SOF:
+            data = f.read(6)
+            if len(data) < 6:
+                return None
+            _, height, width, components = struct.unpack(">BHHB", data)
+            return height, width, 1 if components == 1 else 3, "jpeg"
+        f.seek(struct.unpack(">H", length)[0] - 2, 1)
+
+
+def _tiff_header(f, head):
+    order = "<" if head[:2] == b"II" else ">"
+    f.seek(struct.unpack(order + "I", head[4:8])[0])
+    count = f.read(2)
+    if len(count) < 2:
+        return None
+    entries = f.read(12 * struct.unpack(order + "H", count)[0])
+    tags = {}
+    for pos in range(0, len(entries) - 11, 12):
+        tag, kind = struct.unpack(order + "HH", entries[pos:pos + 4])
+        if tag in (256, 257, 277): # ImageWidth, ImageLength, SamplesPerPixel
+            value = entries[pos + 8:pos + 12]
+            if kind == 3: # SHORT อยู่ 2 byte แรกของช่อง value
+                tags[tag] = struct.unpack(order + "H", value[:2])[0]
+            else:
+                tags[tag] = struct.unpack(order + "I", value)[0]
+    if 256 not in tags or 257 not in tags:
+        return None
+    return tags[257], tags[256], 1 if tags.get(277, 1) == 1 else 3, "tiff"
+
+
+def _iso_boxes(data):
+    """แยก box ของ ISO BMFF/JP2 ใน data คืน (type, payload) ทีละ box"""
+    pos = 0
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        start = pos + 8
+        if size == 1:
+            size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+            start = pos + 16
+        elif size == 0:
+            size = len(data) - pos
+        if size < start - pos:
+            return
+        yield kind, data[start:pos + size]
+        pos += size
+
+
+def _iso_top_box(f, wanted):
+    """หา box ระดับบนสุดชื่อ wanted โดย seek ข้าม box อื่น (เช่น mdat) คืน payload หรือ None"""
+    f.seek(0)
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return None
+        size, kind = struct.unpack(">I4s", head)
+        header_len = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header_len = 16
+        if kind == wanted:
+            length = MAX_HEADER_BOX_BYTES if size == 0 else size - header_len
+            return f.read(min(length, MAX_HEADER_BOX_BYTES))
+        if size < header_len:
+            return None
+        f.seek(size - header_len, 1)
+
+
+def _heif_header(f, head):
+    # major brand + compatible brands ใน ftyp
+    ftyp_end = min(len(head), struct.unpack(">I", head[:4])[0])
+    brands = {head[8:12]} | {head[pos:pos + 4] for pos in range(16, ftyp_end, 4)}
+    if not brands & _HEIF_BRANDS:
+        return None
+    meta = _iso_top_box(f, b"meta")
+    if meta is None:
+        return None
+    # meta เป็น full box (ข้าม version/flags) -> iprp -> ipco -> ispe ของทุกภาพในไฟล์ (ภาพหลัก/thumbnail/alpha)
+    sizes = []
+    for kind, iprp in _iso_boxes(meta[4:]):
+        if kind != b"iprp":
+            continue
+        for kind, ipco in _iso_boxes(iprp):
+            if kind != b"ipco":
+                continue
+            for kind, ispe in _iso_boxes(ipco):
+                if kind == b"ispe" and len(ispe) >= 12:
+                    width, height = struct.unpack(">II", ispe[4:12])
+                    sizes.append((height, width))
+    if not sizes:
+        return None
+    # ใช้ภาพที่ใหญ่ที่สุด (ประมาณต้นทุนเกินไว้ก่อน)
+    height, width = max(sizes, key=lambda hw: hw[0] * hw[1])
+    return height, width, 3, "avif" if brands & _AVIF_BRANDS else "heif"
+
+
+def _jp2_header(f):
+    jp2h = _iso_top_box(f, b"jp2h")
+    if jp2h is None:
+        return None
+    for kind, ihdr in _iso_boxes(jp2h):
+        if kind == b"ihdr" and len(ihdr) >= 10:
+            height, width, components = struct.unpack(">IIH", ihdr[:10])
+            return height, width, 1 if components == 1 else 3, "jp2"
+    return None
+
+
+def _parse_header(f, head):
+    """แยกรูปแบบไฟล์จาก head (64 byte แรก) แล้วอ่านขนาด; raise ถ้า header ขาด/เสีย"""
+    if head[:2] == b"\xff\xd8":
+        return _jpeg_header(f)
+    if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", head[16:24])
+        return height, width, 1 if head[25] == 0 else 3, "png"
+    if head[:2] == b"BM" and len(head) >= 26:
+        width, height = struct.unpack("<ii", head[18:26])
+        return abs(height), width, 3, "bmp"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        chunk = head[12:16]
+        if chunk == b"VP8X":
+            width = 1 + int.from_bytes(head[24:27], "little")
+            height = 1 + int.from_bytes(head[27:30], "little")
+            return height, width, 3, "webp"
+        if chunk == b"VP8L":
+            bits = int.from_bytes(head[21:25], "little")
+            return 1 + ((bits >> 14) & 0x3FFF), 1 + (bits & 0x3FFF), 3, "webp"
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", head[26:30])
+            return height & 0x3FFF, width & 0x3FFF, 3, "webp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return _tiff_header(f, head)
+    if head[4:8] == b"ftyp":
+        return _heif_header(f, head)
+    if head[:12] == _JP2_SIGNATURE:
+        return _jp2_header(f)
+    if head[:4] == b"\xff\x4f\xff\x51" and len(head) >= 42: # codestream JPEG 2000 (SIZ)
+        width, height, x0, y0 = struct.unpack(">IIII", head[8:24])
+        components = struct.unpack(">H", head[40:42])[0]
+        return height - y0, width - x0, 1 if components == 1 else 3, "j2k"
+    return None
+
+
+def read_image_header(path):
+    """
+    อ่าน (height, width, channels, format) จาก header ของ JPEG/PNG/BMP/WebP/TIFF/AVIF/HEIF/JPEG 2000
+    channels คือจำนวนช่องหลัง cv2.imread แบบ IMREAD_ANYCOLOR (1 หรือ 3)
+    คืน None ถ้าไม่รู้จักรูปแบบไฟล์ หรือ header ขาด/เสีย (ใช้ fallback_header แทน)
+    """
+    with open(path, "rb") as f:
+        try:
+            header = _parse_header(f, f.read(64))
+        except (struct.error, IndexError, ValueError, OSError):
+            # ไฟล์ถูกตัด หรือขนาด/offset ใน header ผิด (seek ไปตำแหน่งติดลบ ฯลฯ)
+            return None
+    if header is None or header[0] <= 0 or header[1] <= 0:
+        return None
+    return header
+
+
+def fallback_header(max_pixels):
+    """
+    header สมมติสำหรับไฟล์ที่อ่าน header ไม่ได้ (รูปแบบอื่นที่ OpenCV อาจ decode ได้)
+    ประมาณเป็นภาพสีขนาด max_pixels pixel เพื่อจองหน่วยความจำเกินไว้ก่อนระหว่าง decode เท่านั้น
+    (plan ไม่ย่อภาพตามขนาดสมมตินี้) หลัง decode ให้วางแผนใหม่ด้วย decoded_header
+    """
+    side = math.isqrt(max_pixels)
+    return side, side, 3, "unknown"
+
+
+def decoded_header(img):
+    """header ของภาพที่ decode แล้ว (ย่อได้ด้วย cv2.resize เท่านั้น จึงนับภาพเต็มขนาดไว้ด้วย)"""
+    return img.shape[0], img.shape[1], 1 if img.ndim == 2 else 3, "decoded"
+
+
+def imread_flags(channels, scale=1):
+    """flag ของ cv2.imread สำหรับ decode ที่สเกล 1/scale"""
+    if scale == 1:
+        return cv2.IMREAD_ANYCOLOR
+    return _REDUCED_FLAGS[(channels, scale)]
+
+
+# --- ประมาณต้นทุน ---
+def estimate_cost(op, header, n_blocks, scale=1, autotune=False):
+    """
+    ประมาณหน่วยความจำสูงสุด (bytes) และเวลา CPU (วินาที) ของ op ("embed"/"extract")
+    จากขนาดใน header, จำนวนบล็อกที่จะใช้ และสเกลที่จะ decode
+    """
+    height, width, channels, fmt = header
+    h, w = math.ceil(height / scale), math.ceil(width / scale)
+    pixels = h * w
+    padded = (math.ceil(h / BLOCK_SIZE) * BLOCK_SIZE) * (math.ceil(w / BLOCK_SIZE) * BLOCK_SIZE)
+    n_blocks = min(n_blocks, padded // (BLOCK_SIZE * BLOCK_SIZE))
+
+    # ภาพที่ decode แล้ว (+ YCrCb ถ้าเป็นภาพสี); นอกจาก JPEG OpenCV decode เต็มภาพก่อนย่อ
+    nbytes = pixels * channels
+    if channels == 3:
+        nbytes += pixels * COLOR_PIXEL_BYTES
+    if scale > 1 and fmt != "jpeg":
+        nbytes += height * width * channels
+    nbytes += n_blocks * BLOCK_BYTES
+
+    if op == "embed":
+        nbytes += padded * EMBED_PIXEL_BYTES + pixels * channels # + ภาพผลลัพธ์ที่ encode
+        nbytes += min(n_blocks, SSIM_CHUNK_BLOCKS) * SSIM_BLOCK_BYTES
+        seconds = pixels * EMBED_PIXEL_SECONDS + n_blocks * EMBED_BLOCK_SECONDS
+        if autotune:
+            nbytes += padded * AUTOTUNE_PIXEL_BYTES + n_blocks * BLOCK_BYTES
+            seconds += pixels * AUTOTUNE_PIXEL_SECONDS
+    else:
+        nbytes += padded * EXTRACT_PIXEL_BYTES
+        seconds = pixels * EXTRACT_PIXEL_SECONDS + n_blocks * EXTRACT_BLOCK_SECONDS
+
+    return {"bytes": int(nbytes), "cpu_seconds": seconds, "scale": scale,
+            "imread_flags": imread_flags(channels, scale), "format": fmt}
+
+
+class _Ticket:
+    __slots__ = ("nbytes", "seconds")
+
+    def __init__(self, nbytes, seconds):
+        self.nbytes = nbytes
+        self.seconds = seconds
+
+
+class AdmissionController:
+    """
+    คุมหน่วยความจำรวมของคำขอที่กำลังทำงานใน process นี้ไม่ให้เกิน budget_bytes
+    คำขอที่ยังไม่พอที่จะรันจะรอคิว (FIFO) ได้ไม่เกิน max_queue คำขอ นานไม่เกิน queue_timeout วินาที
+    ภาพที่ใหญ่เกิน budget แม้รันคนเดียว จะถูกย่อตอน decode (เฉพาะ embed) หรือถูกปฏิเสธ
+    """
+
+    def __init__(self, budget_bytes, max_queue=16, queue_timeout=30.0):
+        self.budget_bytes = int(budget_bytes)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._waiting = [] # ticket ที่รอคิวอยู่ ตามลำดับที่มาถึง
+        self._in_flight_bytes = 0
+        self._in_flight_seconds = 0.0
+        self._active = 0
+        self._counters = {"admitted": 0, "queued": 0, "rejected": 0, "reduced": 0}
+        self._peak_bytes = 0
+
+    def plan(self, op, header, n_blocks, autotune=False, extra_bytes=0):
+        """
+        เลือกสเกลที่ย่อน้อยที่สุดที่ทำให้คำขอนี้ใช้หน่วยความจำไม่เกิน budget
+        คืน cost dict (bytes, cpu_seconds, scale, imread_flags, format) หรือ raise AdmissionRejected (413)
+        header จาก fallback_header (ขนาดสมมติ) ไม่ถูกย่อ: จองไม่เกิน budget ไว้ระหว่าง decode
+        แล้วให้ผู้เรียกวางแผนใหม่ด้วยขนาดจริงหลัง decode (ดู adjust)
+        """
+        if header[3] == "unknown":
+            cost = estimate_cost(op, header, n_blocks, 1, autotune)
+            cost["bytes"] = min(cost["bytes"] + extra_bytes, self.budget_bytes)
+            return cost
+
+        scales = (1,) + REDUCED_SCALES if op == "embed" else (1,)
+        for scale in scales:
+            cost = estimate_cost(op, header, n_blocks, scale, autotune)
+            cost["bytes"] += extra_bytes
+            if cost["bytes"] <= self.budget_bytes:
+                return cost
+
+        with self._cond:
+            self._counters["rejected"] += 1
+        height, width = header[:2]
+        raise AdmissionRejected(f"Image too large ({width}x{height})", 413)
+
+    def _fits(self, nbytes):
+        return self._in_flight_bytes + nbytes <= self.budget_bytes
+
+    def _retry_after(self):
+        return max(1, math.ceil(self._in_flight_seconds))
+
+    def acquire(self, cost):
+        """
+        รอจนกว่าจะมีหน่วยความจำพอสำหรับ cost แล้วจองไว้ คืน ticket สำหรับ release
+        raise AdmissionRejected (503) ถ้าคิวเต็มหรือรอนานเกิน queue_timeout
+        """
+        ticket = _Ticket(cost["bytes"], cost["cpu_seconds"])
+        with self._cond:
+            if self._waiting or not self._fits(cost["bytes"]):
+                if len(self._waiting) >= self.max_queue:
+                    self._counters["rejected"] += 1
+                    raise AdmissionRejected("Server busy", 503, self._retry_after())
+
+                # เข้าคิวตามลำดับ คำขอใหม่แซงคำขอที่รออยู่ไม่ได้
+                self._counters["queued"] += 1
+                self._waiting.append(ticket)
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self._waiting[0] is not ticket or not self._fits(cost["bytes"]):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._counters["rejected"] += 1
+                            raise AdmissionRejected("Server busy", 503, self._retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting.remove(ticket)
+                    self._cond.notify_all()
+
+            self._in_flight_bytes += cost["bytes"]
+            self._in_flight_seconds += cost["cpu_seconds"]
+            self._active += 1
+            self._peak_bytes = max(self._peak_bytes, self._in_flight_bytes)
+            self._counters["admitted"] += 1
+            if cost["scale"] > 1:
+                self._counters["reduced"] += 1
+        return ticket
+
+    def adjust(self, ticket, cost):
+        """
+        เปลี่ยนยอดที่ ticket จองไว้เป็น cost ใหม่ (เช่น หลัง decode แล้วรู้ขนาดจริง)
+        ไม่รอคิว เพราะคำขอนี้ถือหน่วยความจำอยู่แล้ว; ยอดที่ลดลงปลุกคำขอที่รอคิว
+        """
+        with self._cond:
+            self._in_flight_bytes += cost["bytes"] - ticket.nbytes
+            self._in_flight_seconds += cost["cpu_seconds"] - ticket.seconds
+            ticket.nbytes = cost["bytes"]
+            ticket.seconds = cost["cpu_seconds"]
+            self._peak_bytes = max(self._peak_bytes, self._in_flight_bytes)
+            if cost["scale"] > 1:
+                self._counters["reduced"] += 1
+            self._cond.notify_all()
+
+    def release(self, ticket):
+        """คืนหน่วยความจำที่จองไว้ และปลุกคำขอที่รอคิว"""
+        with self._cond:
+            self._in_flight_bytes -= ticket.nbytes
+            self._in_flight_seconds -= ticket.seconds
+            self._active -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """ตัวนับและสถานะปัจจุบัน"""
+        with self._cond:
+            return {
+                **self._counters,
+                "active": self._active,
+                "waiting": len(self._waiting),
+                "in_flight_bytes": self._in_flight_bytes,
+                "peak_bytes": self._peak_bytes,
+                "budget_bytes": self.budget_bytes,
+            }
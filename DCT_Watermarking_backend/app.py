@@ -1,4 +1,4 @@
-from flask import Flask, request, send_file, jsonify # 1. เพิ่ม jsonify
+from flask import Flask, request, send_file, jsonify, g # 1. เพิ่ม jsonify
 from flask_cors import CORS
 import cv2
 import numpy as np
@@ -9,12 +9,31 @@ from dct_pairwise import (
     extract_dct_pairwise,
     encode_repetition,
     decode_repetition,
+    verify_dct_pairwise_sequential,
+    embed_dct_multibit,
+    extract_dct_multibit,
+    capacity_multibit,
+    embed_blocks,
+    embed_schedule,
+    MAX_BITS_PER_BLOCK,
+    MATCH_BER,
     pad_to_multiple,
-    unpad_image
+    unpad_image,
+    BLOCK_SIZE
 )
+from quality_metrics import quality_report
+from color_space import split_luma, gather_luma_blocks, scatter_luma_blocks
+from autotune import autotune, REPETITION_CANDIDATES
+from admission import (AdmissionController, AdmissionRejected, read_image_header,
+                       fallback_header, decoded_header)
+from worker_pool import SharedMemoryPool
 
 app = Flask(__name__)
-CORS(app)
+# ให้ frontend อ่านค่าคุณภาพภาพจาก header ได้
+CORS(app, expose_headers=["X-Watermark-PSNR", "X-Watermark-SSIM",
+                          "X-Watermark-T", "X-Watermark-Repetition",
+                          "X-Watermark-Scale", "X-Watermark-Bits-Per-Block",
+                          "X-Watermark-Capacity", "Retry-After"])
 
 UPLOAD_FOLDER = "uploads"
 RESULT_FOLDER = "results"
@@ -25,7 +44,173 @@ os.makedirs(RESULT_FOLDER, exist_ok=True)
 KEY = 42      
 T = 10        
 REPETITION = 3  
+BITS_PER_BLOCK = 1 # บิตต่อบล็อก: 1 = pairwise เดิม, 2 ถึง MAX_BITS_PER_BLOCK = multi-bit (ใช้บล็อกน้อยลง)
 WM_SHAPE = (32, 32) # ขนาดมาตรฐานของลายน้ำ
+SEQ_ERROR_RATE = 1e-3 # อัตราผิดพลาดที่ยอมรับได้ของโหมด sequential
+AUTOTUNE_PSNR_FLOOR = 40.0  # PSNR ขั้นต่ำ (dB) ตอนเลือก T/REPETITION อัตโนมัติ
+AUTOTUNE_BER_CEILING = 0.05 # BER สูงสุดหลัง JPEG Q75 ตอนเลือกอัตโนมัติ
+
+# จำนวน worker process สำหรับงาน embed/extract/autotune/sequential verify (0 = ทำใน process ของ Flask เอง)
+WORKERS = int(os.environ.get("DCT_WORKERS", "0"))
+pool = SharedMemoryPool(WORKERS) if WORKERS > 0 else None
+
+# หน่วยความจำรวมที่คำขอ embed/extract ใน process นี้ใช้พร้อมกันได้ (ประมาณจาก header ของภาพ)
+MEMORY_BUDGET_MB = int(os.environ.get("DCT_MEMORY_BUDGET_MB", "1024"))
+MAX_QUEUE = int(os.environ.get("DCT_MAX_QUEUE", "16"))
+QUEUE_TIMEOUT = 30.0 # วินาที ที่คำขอรอคิวได้
+MAX_UPLOAD_MB = 64   # ขนาดไฟล์ upload สูงสุด (ทั้ง request)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
+# ไฟล์ที่อ่านขนาดจาก header ไม่ได้ จองหน่วยความจำเหมือนภาพสี 1 pixel ต่อ byte ของ upload สูงสุด
+UNKNOWN_IMAGE_PIXELS = app.config["MAX_CONTENT_LENGTH"]
+admission = AdmissionController(MEMORY_BUDGET_MB * 1024 * 1024, MAX_QUEUE, QUEUE_TIMEOUT)
+
+def run_embed(img, bits, strength, bits_per_block=1):
+    if pool is not None:
+        return pool.embed(img, bits, key=KEY, T=strength, bits_per_block=bits_per_block)
+    if bits_per_block == 1:
+        return embed_dct_pairwise(img, bits, key=KEY, T=strength)
+    return embed_dct_multibit(img, bits, key=KEY, T=strength, bits_per_block=bits_per_block)
+
+def run_extract(img, num_bits, bits_per_block=1):
+    if pool is not None:
+        return pool.extract(img, num_bits, key=KEY, bits_per_block=bits_per_block)
+    if bits_per_block == 1:
+        return extract_dct_pairwise(img, num_bits, key=KEY)
+    return extract_dct_multibit(img, num_bits, key=KEY, bits_per_block=bits_per_block)
+
+def run_autotune(img, payload_bits, **kwargs):
+    if pool is not None:
+        return pool.autotune(img, payload_bits, key=KEY, **kwargs)
+    return autotune(img, payload_bits, key=KEY, **kwargs)
+
+def run_verify_sequential(img, expected_bits_encoded, **kwargs):
+    if pool is not None:
+        return pool.verify_sequential(img, expected_bits_encoded, key=KEY, **kwargs)
+    return verify_dct_pairwise_sequential(img, expected_bits_encoded, key=KEY, **kwargs)
+
+def run_embed_color(img, bits, strength, bits_per_block=1):
+    """
+    ฝังลงช่อง Y ของภาพสี (ไม่ต้อง pad) โดยแปลงสีเฉพาะบล็อกตาม key schedule ไป-กลับอย่างละครั้ง
+    ได้ผลเหมือนแปลงทั้งภาพเป็น YCrCb, pad ช่อง Y แล้ว run_embed แต่ไม่แตะ pixel อื่นเลย
+    """
+    h, w = padded_shape(img.shape)
+    total_blocks = (h // BLOCK_SIZE) * (w // BLOCK_SIZE)
+    block_ids, idx1, idx2 = embed_schedule(total_blocks, len(bits), bits_per_block, KEY)
+    blocks = gather_luma_blocks(img, block_ids)
+    luma = np.ascontiguousarray(blocks[..., 0])
+    if pool is not None:
+        blocks[..., 0] = pool.embed_blocks(luma, bits, idx1, idx2, T=strength)
+    else:
+        blocks[..., 0] = embed_blocks(luma, bits, idx1, idx2, T=strength)
+    return scatter_luma_blocks(img.copy(), block_ids, blocks)
+
+def padded_shape(shape):
+    """ขนาด (h, w) ของภาพหลัง pad_to_multiple (ไม่ต้อง pad จริง)"""
+    return tuple(-(-n // BLOCK_SIZE) * BLOCK_SIZE for n in shape[:2])
+
+def form_int(name, default):
+    """อ่านจำนวนเต็มจาก form (คืน None ถ้าไม่ใช่จำนวนเต็ม)"""
+    try:
+        return int(request.form.get(name, default))
+    except ValueError:
+        return None
+
+def form_flag(name):
+    """อ่านค่าเปิด/ปิดจาก form: True/False หรือ None ถ้าไม่ใช่ค่าที่รู้จัก (ไม่ส่งมา = ปิด)"""
+    value = request.form.get(name, "").strip().lower()
+    if value in ("1", "true", "yes", "on"):
+        return True
+    if value in ("", "0", "false", "no", "off"):
+        return False
+    return None
+
+def form_bits_per_block():
+    """bits_per_block จาก form (คืน None ถ้าไม่อยู่ในช่วง 1 ถึง MAX_BITS_PER_BLOCK)"""
+    bits_per_block = form_int("bits_per_block", BITS_PER_BLOCK)
+    if bits_per_block is None or not 1 <= bits_per_block <= MAX_BITS_PER_BLOCK:
+        return None
+    return bits_per_block
+
+def bad_request(message):
+    return jsonify({"success": False, "error": message}), 400
+
+def admit(op, img_path, wm_path, n_blocks, tuned=False):
+    """
+    อ่านขนาดภาพจาก header (ก่อน decode) แล้วจองหน่วยความจำกับ admission
+    คืน cost dict (มี imread_flags/scale ของภาพหลัก); จองไว้จนจบ request
+    ถ้าอ่าน header ของไฟล์ใดไม่ได้ จะจองตามขนาดสมมติ (ไม่ย่อ) แล้วต้องเรียก replan หลัง decode
+    """
+    header = read_image_header(img_path)
+    wm_header = read_image_header(wm_path)
+    if header is None or wm_header is None:
+        header = wm_header = fallback_header(UNKNOWN_IMAGE_PIXELS)
+
+    # ลายน้ำถูก decode เต็มภาพแบบเทาก่อนย่อเหลือ WM_SHAPE
+    cost = admission.plan(op, header, n_blocks, tuned, extra_bytes=wm_header[0] * wm_header[1])
+    g.admission_ticket = admission.acquire(cost)
+    return cost
+
+def replan(op, cost, img, wm_img, n_blocks, tuned=False):
+    """
+    หลัง decode: ถ้า admit จองตามขนาดสมมติ ให้วางแผนใหม่จากขนาดจริงและปรับยอดที่จองไว้
+    embed ที่เกิน budget ถูกย่อด้วย cv2.resize ตามสเกลที่เลือก คืน (img, cost)
+    """
+    if cost["format"] != "unknown":
+        return img, cost
+    cost = admission.plan(op, decoded_header(img), n_blocks, tuned, extra_bytes=wm_img.size)
+    admission.adjust(g.admission_ticket, cost)
+    scale = cost["scale"]
+    if scale > 1:
+        h, w = img.shape[:2]
+        img = cv2.resize(img, (-(-w // scale), -(-h // scale)), interpolation=cv2.INTER_AREA)
+    return img, cost
+
+@app.teardown_request
+def release_admission(exc):
+    ticket = g.pop("admission_ticket", None)
+    if ticket is not None:
+        admission.release(ticket)
+
+@app.errorhandler(AdmissionRejected)
+def admission_rejected(e):
+    response = jsonify({"success": False, "error": str(e)})
+    response.status_code = e.status
+    if e.retry_after is not None:
+        response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+@app.route("/admission", methods=["GET"])
+def admission_stats():
+    # ตัวนับคำขอที่ถูกรับ/รอคิว/ปฏิเสธ/ย่อภาพ และหน่วยความจำที่จองอยู่
+    return jsonify(admission.stats())
+
+@app.route("/capacity", methods=["POST"])
+def capacity():
+    """
+    ความจุของภาพก่อนเรียก /embed (อ่านขนาดจาก header ไม่ต้อง decode)
+    คืนจำนวนบิต (รวม ECC) ที่ฝังได้ของแต่ละ bits_per_block และจำนวนบิตที่ลายน้ำต้องใช้
+    ภาพที่ /embed ต้องย่อ (X-Watermark-Scale > 1) จะจุได้น้อยกว่านี้ ดู X-Watermark-Capacity ของ /embed
+    """
+    img_file = request.files["image"]
+    img_path = os.path.join(UPLOAD_FOLDER, img_file.filename)
+    img_file.save(img_path)
+
+    repetition = form_int("repetition", REPETITION)
+    if repetition is None or repetition < 1:
+        return bad_request("repetition must be a positive integer")
+
+    header = read_image_header(img_path)
+    if header is None:
+        return jsonify({"success": False, "error": "Unsupported image format"}), 415
+    height, width = header[:2]
+    shape = padded_shape((height, width))
+    return jsonify({
+        "success": True,
+        "width": width,
+        "height": height,
+        "required_bits": WM_SHAPE[0] * WM_SHAPE[1] * repetition,
+        "capacity": {str(k): capacity_multibit(shape, k) for k in range(1, MAX_BITS_PER_BLOCK + 1)},
+    })
 
 @app.route("/embed", methods=["POST"])
 def embed():
@@ -37,31 +222,82 @@ def embed():
     img_file.save(img_path)
     wm_file.save(wm_path)
 
-    img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+    bits_per_block = form_bits_per_block()
+    if bits_per_block is None:
+        return bad_request(f"bits_per_block must be an integer from 1 to {MAX_BITS_PER_BLOCK}")
+
+    # จำนวนบล็อกสูงสุดที่อาจใช้ (autotune อาจเลือก REPETITION ที่มากกว่าค่าเริ่มต้น)
+    tune = form_flag("autotune")
+    if tune is None:
+        return bad_request("autotune must be 0 or 1")
+    if tune and bits_per_block != 1:
+        return bad_request("autotune supports bits_per_block=1 only")
+    max_repetition = max(REPETITION_CANDIDATES + (REPETITION,)) if tune else REPETITION
+    max_blocks = -(-WM_SHAPE[0] * WM_SHAPE[1] * max_repetition // bits_per_block)
+    cost = admit("embed", img_path, wm_path, max_blocks, tune)
+
+    # ภาพสีฝังลงช่อง Y (YCrCb) ส่วน Cr/Cb ไม่ถูกแตะ
+    # ภาพที่ใหญ่เกิน budget ถูกย่อ 1/scale ตั้งแต่ตอน decode (ผลลัพธ์จะเล็กลงตามนั้น)
+    img = cv2.imread(img_path, cost["imread_flags"])
     wm_img = cv2.imread(wm_path, cv2.IMREAD_GRAYSCALE)
+    if img is None or wm_img is None:
+        return jsonify({"success": False, "error": "Unsupported image format"}), 415
+    img, cost = replan("embed", cost, img, wm_img, max_blocks, tune)
 
-    img_padded, original_shape = pad_to_multiple(img, block_size=8)
-    
     wm_resized = cv2.resize(wm_img, WM_SHAPE)
     _, wm_binary = cv2.threshold(wm_resized, 127, 1, cv2.THRESH_BINARY)
     
     original_watermark_bits = wm_binary.flatten()
+
+    # เลือก T/REPETITION ตามภาพ (ถ้าขอ) ไม่ผ่านเป้าก็ใช้ค่าคงที่เดิม
+    strength, repetition = T, REPETITION
+    if tune:
+        # autotune ต้องใช้ช่อง Y ทั้งภาพ (ภาพสีจึงแปลงทั้งภาพเฉพาะกรณีนี้)
+        tuned = run_autotune(
+            pad_to_multiple(split_luma(img)[1], block_size=8)[0],
+            original_watermark_bits,
+            psnr_floor=AUTOTUNE_PSNR_FLOOR,
+            ber_ceiling=AUTOTUNE_BER_CEILING
+        )
+        if tuned is not None:
+            strength, repetition = tuned["T"], tuned["repetition"]
     
-    bits_to_embed = encode_repetition(original_watermark_bits, REPETITION) 
-
-    watermarked_img_padded = embed_dct_pairwise(
-        img_padded, 
-        bits_to_embed, 
-        key=KEY, 
-        T=T
-    )
-    
-    watermarked_img = unpad_image(watermarked_img_padded, original_shape)
+    bits_to_embed = encode_repetition(original_watermark_bits, repetition) 
+
+    h_padded, w_padded = padded_shape(img.shape)
+    capacity = capacity_multibit((h_padded, w_padded), bits_per_block)
+    if len(bits_to_embed) > capacity:
+        return bad_request(f"Image too small: {len(bits_to_embed)} bits needed, "
+                           f"{capacity} fit at {bits_per_block} bits per block")
+
+    # ภาพเทา: pad แล้วฝังทั้งภาพ จากนั้นตัดส่วนที่ pad ออก
+    # ภาพสี: แปลงสีเฉพาะบล็อกที่ถูกฝัง ไม่ต้องแปลง/pad ทั้งภาพ
+    if img.ndim == 2:
+        img_padded, original_shape = pad_to_multiple(img, block_size=8)
+        watermarked_img = unpad_image(run_embed(img_padded, bits_to_embed, strength, bits_per_block),
+                                      original_shape)
+    else:
+        watermarked_img = run_embed_color(img, bits_to_embed, strength, bits_per_block)
+
+    # วัด PSNR/SSIM (ของช่อง Y) เฉพาะบล็อกที่ถูกฝัง (บล็อกอื่นไม่ถูกแตะ) บนภาพขนาดเดิม
+    total_blocks = (h_padded // BLOCK_SIZE) * (w_padded // BLOCK_SIZE)
+    embedded_blocks = embed_schedule(total_blocks, len(bits_to_embed), bits_per_block, KEY)[0]
+    quality = quality_report(img, watermarked_img, embedded_blocks)
 
     out_path = os.path.join(RESULT_FOLDER, "watermarked.png")
     cv2.imwrite(out_path, watermarked_img)
 
-    return send_file(out_path, mimetype="image/png")
+    response = send_file(out_path, mimetype="image/png")
+    response.headers["X-Watermark-PSNR"] = f"{quality['psnr']:.2f}"
+    response.headers["X-Watermark-SSIM"] = f"{quality['ssim']:.4f}"
+    # ต้องส่ง repetition นี้กลับมาตอน /extract
+    response.headers["X-Watermark-T"] = str(strength)
+    response.headers["X-Watermark-Repetition"] = str(repetition)
+    response.headers["X-Watermark-Bits-Per-Block"] = str(bits_per_block)
+    # จำนวนบิต (รวม ECC) ที่ภาพผลลัพธ์จุได้ที่ bits_per_block นี้ (หลังย่อแล้ว ถ้าถูกย่อ)
+    response.headers["X-Watermark-Capacity"] = str(capacity)
+    response.headers["X-Watermark-Scale"] = str(cost["scale"])
+    return response
 
 @app.route("/extract", methods=["POST"])
 def extract_and_verify():
@@ -74,28 +310,78 @@ def extract_and_verify():
     img_file.save(img_path)
     wm_file.save(wm_path)
 
-    watermarked = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
-    watermarked_padded, _ = pad_to_multiple(watermarked, block_size=8)
+    num_original_bits = WM_SHAPE[0] * WM_SHAPE[1]        # 1024
+    repetition = form_int("repetition", REPETITION)
+    if repetition is None or repetition < 1:
+        return bad_request("repetition must be a positive integer")
+    num_encoded_bits = num_original_bits * repetition     # 3072
 
+    # ต้องตรงกับ X-Watermark-Bits-Per-Block ที่ได้จาก /embed
+    bits_per_block = form_bits_per_block()
+    if bits_per_block is None:
+        return bad_request(f"bits_per_block must be an integer from 1 to {MAX_BITS_PER_BLOCK}")
+    sequential = request.form.get("mode") == "sequential"
+    if sequential and bits_per_block != 1:
+        return bad_request("sequential mode supports bits_per_block=1 only")
+
+    # extract ย่อภาพไม่ได้ (ลายน้ำอยู่ที่ความละเอียดเดิม) ภาพที่ใหญ่เกิน budget จึงถูกปฏิเสธ
+    n_blocks = -(-num_encoded_bits // bits_per_block)
+    cost = admit("extract", img_path, wm_path, n_blocks)
+
+    watermarked = cv2.imread(img_path, cost["imread_flags"])
     #โหลด "ลายน้ำต้นฉบับ" เพื่อใช้เปรียบเทียบ
     wm_img_orig = cv2.imread(wm_path, cv2.IMREAD_GRAYSCALE)
+    if watermarked is None or wm_img_orig is None:
+        return jsonify({"success": False, "error": "Unsupported image format"}), 415
+    replan("extract", cost, watermarked, wm_img_orig, n_blocks)
+
+    watermarked_padded, _ = pad_to_multiple(split_luma(watermarked)[1], block_size=8)
+
+    # repetition ที่ต้องใช้บิตมากกว่าที่ภาพจุได้ ไม่ได้มาจาก /embed แน่นอน
+    capacity = capacity_multibit(watermarked_padded.shape, bits_per_block)
+    if num_encoded_bits > capacity:
+        return bad_request(f"repetition {repetition} needs {num_encoded_bits} bits, "
+                           f"image holds {capacity} at {bits_per_block} bits per block")
     wm_resized_orig = cv2.resize(wm_img_orig, WM_SHAPE)
     _, wm_binary_orig = cv2.threshold(wm_resized_orig, 127, 1, cv2.THRESH_BINARY)
     
     original_bits = wm_binary_orig.flatten()
 
-    num_original_bits = len(original_bits)                # 1024
-    num_encoded_bits = num_original_bits * REPETITION     # 3072
+    # โหมด sequential: ตรวจทีละ chunk และหยุดเมื่อมั่นใจพอ (ไม่ต้องสกัดครบ 3072 บิต)
+    if sequential:
+        result = run_verify_sequential(
+            watermarked_padded,
+            encode_repetition(original_bits, repetition),
+            repetition=repetition,
+            alpha=SEQ_ERROR_RATE,
+            beta=SEQ_ERROR_RATE
+        )
+        raw_ber = (result["bit_errors"] / max(result["bits_used"], 1)) * 100
+        confidence = result["confidence"]
+        if result["decided"]:
+            detail = f"after {result['bits_used']} bits (confidence {confidence:.4f})"
+        else:
+            # SPRT ตัดสินไม่ได้ (เช่นโลโก้พื้นขาว): ใช้ทุกบิตและเกณฑ์ BER เดียวกับโหมดเต็ม
+            detail = f"(SPRT undecided; used all {result['bits_used']} bits and the full-mode BER rule)"
+        return jsonify({
+            "success": True,
+            "mode": "sequential",
+            "is_match": bool(result["is_match"]),
+            "decided": result["decided"],
+            "confidence": None if confidence is None else round(confidence, 6),
+            "bits_used": result["bits_used"],
+            "bit_errors": result["bit_errors"],
+            # นับเป็นบิตที่ฝังจริง (รวม ECC) ไม่ใช่บิตของ payload เหมือนโหมดเต็ม จึงใช้ชื่อต่างกัน
+            "encoded_bits": int(num_encoded_bits),
+            "raw_ber": round(raw_ber, 2),
+            "message": f"Sequential verify: {'match' if result['is_match'] else 'no match'} {detail}"
+        })
     
     # จ. สกัดลายน้ำ
-    extracted_encoded_bits = extract_dct_pairwise(
-        watermarked_padded, 
-        num_encoded_bits, 
-        key=KEY
-    )
+    extracted_encoded_bits = run_extract(watermarked_padded, num_encoded_bits, bits_per_block)
     
     # ฉ. ถอดรหัส ECC
-    extracted_bits = decode_repetition(extracted_encoded_bits, REPETITION)
+    extracted_bits = decode_repetition(extracted_encoded_bits, repetition)
     extracted_bits = extracted_bits[:num_original_bits] # ตัดให้เหลือขนาดเท่า original
     
     
@@ -107,8 +393,8 @@ def extract_and_verify():
     total_bits = num_original_bits
     ber = (bit_errors / total_bits) * 100 # (ค่า BER เป็นเปอร์เซ็นต์)
 
-    # ผิดพลาดได้ไม่เกิน 10%
-    match_threshold = 10.0
+    # ผิดพลาดได้ไม่เกิน 10% (MATCH_BER, เกณฑ์เดียวกับโหมด sequential)
+    match_threshold = MATCH_BER * 100
     is_match = bool(ber <= match_threshold)
 
 
@@ -0,0 +1,218 @@
+import math
+
+import cv2
+import numpy as np
+
+from dct_pairwise import (
+    BLOCK_SIZE,
+    KEY,
+    MID_BAND,
+    key_schedule,
+    encode_repetition,
+    decode_repetition,
+    gather_blocks,
+    scatter_blocks,
+    dct_blocks,
+    idct_blocks,
+    pair_coeffs,
+    pair_diffs,
+    pairwise_shifts,
+    apply_pairwise_shifts,
+)
+from quality_metrics import psnr
+
+# --- ค่าเริ่มต้นของการค้นหา ---
+T_CANDIDATES = (4, 6, 8, 10, 12, 14, 16, 20, 24)
+REPETITION_CANDIDATES = (1, 3, 5)
+JPEG_QUALITY = 75
+SHORTLIST = 3 # จำนวนตัวเลือกสูงสุดที่จะลองโจมตี/สกัดจริง
+
+# error จากการปัดเศษ (astype uint8 = ปัดลง) ต่อ pixel ของบล็อกที่ผ่าน IDCT: E[u^2], u ~ U(0, 1)
+_TRUNCATION_MSE = 1.0 / 3.0
+
+# noise ที่เหลือบนสัมประสิทธิ์ก่อน JPEG quantize (การปัดเศษ pixel, integer DCT ของ encoder)
+COEFF_NOISE_STD = 1.0
+
+# ตาราง quantization ของ luminance มาตรฐาน JPEG (Annex K) ที่ quality 50
+JPEG_LUMA_Q50 = np.array([
+    [16, 11, 10, 16, 24, 40, 51, 61],
+    [12, 12, 14, 19, 26, 58, 60, 55],
+    [14, 13, 16, 24, 40, 57, 69, 56],
+    [14, 17, 22, 29, 51, 87, 80, 62],
+    [18, 22, 37, 56, 68, 109, 103, 77],
+    [24, 35, 55, 64, 81, 104, 113, 92],
+    [49, 64, 78, 87, 103, 121, 120, 101],
+    [72, 92, 95, 98, 112, 100, 103, 99],
+], dtype=np.float64)
+
+
+def jpeg_quant_table(quality):
+    """ตาราง quantization ตาม quality (สูตรเดียวกับ libjpeg)"""
+    quality = min(max(int(quality), 1), 100)
+    scale = 5000 / quality if quality < 50 else 200 - 2 * quality
+    table = np.floor((JPEG_LUMA_Q50 * scale + 50) / 100)
+    return np.clip(table, 1, 255)
+
+
+def _erf(x):
+    """erf แบบ vectorized (Abramowitz & Stegun 7.1.26, error < 1.5e-7)"""
+    sign = np.sign(x)
+    x = np.abs(x)
+    t = 1.0 / (1.0 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741
+                + t * (-1.453152027 + t * 1.061405429))))
+    return sign * (1.0 - poly * np.exp(-x * x))
+
+
+def _quantized_levels(x, q, sigma):
+    """
+    ระดับ quantization ที่เป็นไปได้ของ x + noise (noise ~ N(0, sigma^2))
+    คืน (levels, probs) รูป (3, N): ระดับที่ใกล้ที่สุดและเพื่อนบ้านสองข้าง
+    """
+    k = np.round(x / q)
+    lower = ((k - 0.5) * q - x) / (sigma * math.sqrt(2.0))
+    upper = ((k + 0.5) * q - x) / (sigma * math.sqrt(2.0))
+    p_down = 0.5 * (1.0 + _erf(lower))
+    p_up = 0.5 * (1.0 - _erf(upper))
+    levels = np.stack([k - 1, k, k + 1]) * q
+    probs = np.stack([p_down, 1.0 - p_down - p_up, p_up])
+    return levels, probs
+
+
+def _flip_probability(c1, c2, q1, q2, bits, sigma=COEFF_NOISE_STD):
+    """โอกาสที่บิตจะพลิกหลัง JPEG: จำลอง quantization ของ c1/c2 พร้อม noise เล็กน้อย"""
+    levels1, probs1 = _quantized_levels(c1, q1, sigma)
+    levels2, probs2 = _quantized_levels(c2, q2, sigma)
+    p_flip = np.zeros(len(c1))
+    for i in range(3):
+        for j in range(3):
+            diff = levels1[i] - levels2[j]
+            # ถ้า quantize แล้วเท่ากัน เครื่องหมายจะขึ้นกับ noise ที่เหลือ -> โอกาสครึ่งหนึ่ง
+            wrong = np.where(diff == 0, 0.5, (diff > 0) != (bits == 1))
+            p_flip += probs1[i] * probs2[j] * wrong
+    return p_flip
+
+
+def _majority_error_rate(p_flip, bits, repetition):
+    """
+    BER ที่คาดหวังหลัง decode_repetition จากโอกาสบิตพลิกของแต่ละบล็อก
+    p_flip: (n_bits * repetition,), bits: บิตต้นฉบับ (n_bits,)
+    """
+    p = p_flip.reshape(-1, repetition)
+    # การแจกแจงของจำนวนบิตที่พลิก (Poisson-binomial) ทำทีละคอลัมน์
+    dist = np.zeros((len(p), repetition + 1))
+    dist[:, 0] = 1.0
+    for j in range(repetition):
+        shifted = np.zeros_like(dist)
+        shifted[:, 1:] = dist[:, :-1] * p[:, j:j + 1]
+        dist = dist * (1.0 - p[:, j:j + 1]) + shifted
+
+    # decode_repetition ให้ 1 เมื่อจำนวน 1 >= repetition // 2 + 1
+    need = repetition // 2 + 1
+    flips = np.arange(repetition + 1)
+    wrong_if_one = flips > repetition - need   # บิต 1 เหลือ 1 ไม่ถึง need
+    wrong_if_zero = flips >= need              # บิต 0 กลายเป็น 1 ถึง need
+    err = np.where(bits == 1, dist[:, wrong_if_one].sum(axis=1), dist[:, wrong_if_zero].sum(axis=1))
+    return float(err.mean())
+
+
+def _jpeg_attack(img, quality):
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    if not ok:
+        raise ValueError("JPEG encode ล้มเหลว")
+    return cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
+
+
+def autotune(img, payload_bits, key=KEY, psnr_floor=40.0, ber_ceiling=0.05,
+             t_candidates=T_CANDIDATES, repetitions=REPETITION_CANDIDATES,
+             jpeg_quality=JPEG_QUALITY, shortlist=SHORTLIST):
+    """
+    เลือก T และ REPETITION ที่ "ถูกที่สุด" (distortion น้อยสุด) ที่ยังได้
+    PSNR >= psnr_floor และ BER (หลัง JPEG ที่ jpeg_quality) <= ber_ceiling
+
+    ทำ DCT ของบล็อกตาม key schedule แค่ครั้งเดียว แล้วประมาณ PSNR/BER
+    ของทุกตัวเลือกจากผลต่างคู่สัมประสิทธิ์ที่ cache ไว้
+    จากนั้นจึงฝัง/โจมตี/สกัดจริงเฉพาะตัวเลือกที่ดีที่สุด shortlist ตัว
+
+    img: ภาพ uint8 ที่ pad ให้หาร 8 ลงตัวแล้ว
+    payload_bits: บิตลายน้ำ (ก่อน ECC)
+    คืน dict ของตัวเลือกที่ผ่าน หรือ None ถ้าไม่มีตัวเลือกใดผ่านเป้า
+    """
+    h, w = img.shape
+    if h % BLOCK_SIZE != 0 or w % BLOCK_SIZE != 0:
+        raise ValueError("ขนาดภาพต้องหาร 8 ลงตัว (ควร Pad ภาพก่อน)")
+
+    payload_bits = np.asarray(payload_bits, dtype=np.uint8)
+    total_blocks = (h // BLOCK_SIZE) * (w // BLOCK_SIZE)
+    repetitions = [r for r in repetitions if len(payload_bits) * r <= total_blocks]
+    if not repetitions:
+        return None
+
+    # --- 1. DCT ของบล็อกที่ใช้ได้ทั้งหมด (ครั้งเดียว) ---
+    n_max = len(payload_bits) * max(repetitions)
+    block_ids, idx1, idx2 = key_schedule(total_blocks, n_max, key)
+    coeffs = dct_blocks(gather_blocks(img, block_ids))
+    c1, c2 = pair_coeffs(coeffs, idx1, idx2)
+    diffs = c1 - c2
+
+    # ขั้น quantization ของ JPEG ที่ตำแหน่ง c1/c2 ของแต่ละบล็อก
+    qtable = jpeg_quant_table(jpeg_quality)
+    band_q = np.array([qtable[u, v] for u, v in MID_BAND])
+    q1 = band_q[idx1]
+    q2 = band_q[idx2]
+
+    # --- 2. ประมาณ PSNR / BER ของทุกตัวเลือกจาก diffs ---
+    candidates = []
+    for r in repetitions:
+        bits = encode_repetition(payload_bits, r)
+        n = len(bits)
+        for t in t_candidates:
+            shifts = pairwise_shifts(diffs[:n], bits, t).astype(np.float64)
+            # DCT แบบ orthonormal: เลื่อน c1 +s, c2 -s = พลังงานเปลี่ยน 2s^2 ใน spatial domain
+            sq_error = 2.0 * np.dot(shifts, shifts) + n * BLOCK_SIZE * BLOCK_SIZE * _TRUNCATION_MSE
+            mse = sq_error / img.size
+            pred_psnr = 10.0 * math.log10(255.0 ** 2 / mse)
+            if pred_psnr < psnr_floor:
+                continue
+
+            # จำลอง quantization ของ JPEG บน c1/c2 หลังฝัง แล้วดูว่าเครื่องหมายของผลต่างยังถูกไหม
+            p_flip = _flip_probability(c1[:n] + shifts, c2[:n] - shifts, q1[:n], q2[:n], bits)
+            pred_ber = _majority_error_rate(p_flip, payload_bits, r)
+            if pred_ber > ber_ceiling:
+                continue
+
+            candidates.append((mse, r, t, pred_psnr, pred_ber))
+
+    candidates.sort()
+
+    # --- 3. ฝัง/โจมตี/สกัดจริงเฉพาะ shortlist (ใช้ DCT ที่ cache ไว้) ---
+    for checked, (_, r, t, pred_psnr, pred_ber) in enumerate(candidates[:shortlist], start=1):
+        bits = encode_repetition(payload_bits, r)
+        n = len(bits)
+
+        marked_coeffs = coeffs[:n].copy()
+        apply_pairwise_shifts(marked_coeffs, idx1[:n], idx2[:n],
+                              pairwise_shifts(diffs[:n], bits, t))
+        watermarked = img.astype(np.float32)
+        scatter_blocks(watermarked, block_ids[:n], idct_blocks(marked_coeffs))
+        watermarked = np.clip(watermarked, 0, 255).astype(np.uint8)
+
+        attacked = _jpeg_attack(watermarked, jpeg_quality)
+        extracted = (pair_diffs(dct_blocks(gather_blocks(attacked, block_ids[:n])),
+                                idx1[:n], idx2[:n]) > 0).astype(np.uint8)
+        decoded = decode_repetition(extracted, r)[:len(payload_bits)]
+        ber = float(np.mean(decoded != payload_bits))
+        quality = psnr(img, watermarked, block_ids[:n])
+
+        if quality >= psnr_floor and ber <= ber_ceiling:
+            return {
+                "T": t,
+                "repetition": r,
+                "psnr": quality,
+                "ber": ber,
+                "predicted_psnr": pred_psnr,
+                "predicted_ber": pred_ber,
+                "candidates_checked": checked,
+            }
+
+    return None
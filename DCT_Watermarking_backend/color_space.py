@@ -0,0 +1,80 @@
+import cv2
+import numpy as np
+
+from dct_pairwise import BLOCK_SIZE
+
+
+def split_luma(img):
+    """
+    แปลง BGR -> YCrCb ครั้งเดียว คืน (ycrcb, y) โดย y เป็น view ของช่อง Y (ไม่ copy)
+    ภาพเทา (2 มิติ) คืน (None, img) ตามเดิม
+    """
+    if img.ndim == 2:
+        return None, img
+    ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
+    return ycrcb, ycrcb[:, :, 0]
+
+
+def _block_view(img, nb_h, nb_w):
+    """มอง img[:nb_h*8, :nb_w*8] เป็น (nb_h, 8, nb_w, 8, ...) โดยไม่ copy"""
+    region = img[:nb_h * BLOCK_SIZE, :nb_w * BLOCK_SIZE]
+    return region.reshape((nb_h, BLOCK_SIZE, nb_w, BLOCK_SIZE) + img.shape[2:])
+
+
+def _pad_index(pos, size):
+    """index ในภาพของตำแหน่ง pos บนภาพหลัง pad_to_multiple (ส่วนที่เลยขอบสะท้อนแบบ np.pad 'reflect')"""
+    return np.where(pos < size, pos, 2 * (size - 1) - pos)
+
+
+def _block_layout(img, block_ids):
+    """(by, bx, full) ของ block_ids บนตารางของภาพหลัง pad_to_multiple; full = บล็อกอยู่ในภาพทั้งบล็อก"""
+    h, w = img.shape[:2]
+    nb_w = -(-w // BLOCK_SIZE)
+    block_ids = np.asarray(block_ids, dtype=np.intp)
+    by, bx = block_ids // nb_w, block_ids % nb_w
+    return by, bx, (by < h // BLOCK_SIZE) & (bx < w // BLOCK_SIZE)
+
+
+def gather_luma_blocks(img, block_ids):
+    """
+    ดึงบล็อก 8x8 ของภาพสี BGR ตาม block_ids แล้วแปลงเป็น YCrCb ด้วย cvtColor ครั้งเดียว คืน (N, 8, 8, 3)
+    เลขบล็อกนับบนตารางของภาพหลัง pad_to_multiple: ส่วนของบล็อกที่เลยขอบภาพเติมแบบ reflect
+    ให้ช่อง Y ตรงกับ pad_to_multiple(split_luma(img)[1]) โดยไม่ต้องแปลงสีหรือ pad ทั้งภาพ
+    """
+    h, w = img.shape[:2]
+    by, bx, full = _block_layout(img, block_ids)
+    blocks = np.empty((len(by), BLOCK_SIZE, BLOCK_SIZE, 3), dtype=np.uint8)
+    if len(blocks) == 0:
+        return blocks
+
+    blocks[full] = _block_view(img, h // BLOCK_SIZE, w // BLOCK_SIZE)[by[full], :, bx[full], :]
+    edge = ~full
+    if edge.any():
+        offset = np.arange(BLOCK_SIZE)
+        rows = _pad_index(by[edge][:, None] * BLOCK_SIZE + offset, h)
+        cols = _pad_index(bx[edge][:, None] * BLOCK_SIZE + offset, w)
+        blocks[edge] = img[rows[:, :, None], cols[:, None, :]]
+
+    ycrcb = cv2.cvtColor(blocks.reshape(-1, BLOCK_SIZE, 3), cv2.COLOR_BGR2YCrCb)
+    return ycrcb.reshape(blocks.shape)
+
+
+def scatter_luma_blocks(img, block_ids, ycrcb_blocks):
+    """
+    แปลงบล็อก YCrCb (N, 8, 8, 3) กลับเป็น BGR ครั้งเดียว แล้วเขียนลงภาพสี img ตาม block_ids (แก้ img โดยตรง)
+    บล็อกที่ขอบขวา/ล่างเขียนกลับเฉพาะส่วนที่อยู่ในภาพ ส่วน pixel อื่นของ img คงค่าเดิมทุกประการ
+    """
+    h, w = img.shape[:2]
+    by, bx, full = _block_layout(img, block_ids)
+    if len(by) == 0:
+        return img
+
+    bgr = cv2.cvtColor(np.ascontiguousarray(ycrcb_blocks).reshape(-1, BLOCK_SIZE, 3), cv2.COLOR_YCrCb2BGR)
+    bgr = bgr.reshape(ycrcb_blocks.shape)
+
+    _block_view(img, h // BLOCK_SIZE, w // BLOCK_SIZE)[by[full], :, bx[full], :] = bgr[full]
+    for i in np.flatnonzero(~full):
+        y0, x0 = by[i] * BLOCK_SIZE, bx[i] * BLOCK_SIZE
+        part = img[y0:y0 + BLOCK_SIZE, x0:x0 + BLOCK_SIZE]
+        part[...] = bgr[i, :part.shape[0], :part.shape[1]]
+    return img
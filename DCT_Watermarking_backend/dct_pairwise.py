@@ -1,3 +1,6 @@
+import math
+from functools import lru_cache
+
 import cv2
 import numpy as np
 
@@ -25,6 +28,116 @@ def unpad_image(img, original_shape):
     h, w = original_shape
     return img[:h, :w]
 
+@lru_cache(maxsize=32)
+def key_schedule(total_blocks, n_blocks, key=KEY):
+    """
+    ลำดับบล็อกและคู่สัมประสิทธิ์ตาม key (เหมือนที่ embed/extract ใช้)
+    คืน (block_ids, idx1, idx2) ของ n_blocks บล็อกแรก เป็น array แบบอ่านอย่างเดียว
+    """
+    rng_master = np.random.RandomState(key)
+    block_ids = np.arange(total_blocks)
+    rng_master.shuffle(block_ids)
+    # copy เพื่อไม่ให้ cache ถือ permutation ของทุกบล็อกไว้ (view จะอ้างถึง array เต็ม)
+    block_ids = block_ids[:n_blocks].copy()
+
+    idx1 = np.empty(len(block_ids), dtype=np.intp)
+    idx2 = np.empty(len(block_ids), dtype=np.intp)
+    # seed ซ้ำบน RandomState ตัวเดียว ได้ลำดับเดียวกับ RandomState(key + b_id) แต่เร็วกว่ามาก
+    rng_block = np.random.RandomState()
+    for i, b_id in enumerate(block_ids):
+        rng_block.seed(key + b_id)
+        idx1[i] = rng_block.randint(N_MID_BAND)
+        idx2[i] = (idx1[i] + 1 + rng_block.randint(N_MID_BAND - 1)) % N_MID_BAND
+
+    for arr in (block_ids, idx1, idx2):
+        arr.setflags(write=False)
+    return block_ids, idx1, idx2
+
+# --- ตัวช่วยแบบ vectorized: ทำ DCT/IDCT หลายบล็อกพร้อมกัน ---
+_MID_BAND_U = np.array([u for u, _ in MID_BAND])
+_MID_BAND_V = np.array([v for _, v in MID_BAND])
+
+def gather_blocks(img, block_ids):
+    """ดึงบล็อก 8x8 ตาม block_ids เป็น array (N, 8, 8) แบบ float32"""
+    h, w = img.shape
+    nb_w = w // BLOCK_SIZE
+    view = img.reshape(h // BLOCK_SIZE, BLOCK_SIZE, nb_w, BLOCK_SIZE)
+    return view[block_ids // nb_w, :, block_ids % nb_w, :].astype(np.float32)
+
+def scatter_blocks(img, block_ids, blocks):
+    """เขียนบล็อก (N, 8, 8) กลับลงภาพตาม block_ids (แก้ img โดยตรง)"""
+    h, w = img.shape
+    nb_w = w // BLOCK_SIZE
+    view = img.reshape(h // BLOCK_SIZE, BLOCK_SIZE, nb_w, BLOCK_SIZE)
+    view[block_ids // nb_w, :, block_ids % nb_w, :] = blocks
+
+def _dct_rows_then_cols(blocks, flags):
+    n = len(blocks)
+    rows = cv2.dct(np.ascontiguousarray(blocks, dtype=np.float32).reshape(-1, BLOCK_SIZE),
+                   flags=flags | cv2.DCT_ROWS)
+    rows = rows.reshape(n, BLOCK_SIZE, BLOCK_SIZE).transpose(0, 2, 1)
+    cols = cv2.dct(np.ascontiguousarray(rows).reshape(-1, BLOCK_SIZE), flags=flags | cv2.DCT_ROWS)
+    return cols.reshape(n, BLOCK_SIZE, BLOCK_SIZE).transpose(0, 2, 1)
+
+def dct_blocks(blocks):
+    """DCT 2 มิติของทุกบล็อกใน (N, 8, 8) ด้วย cv2.dct แบบ DCT_ROWS สองรอบ"""
+    return _dct_rows_then_cols(blocks, 0)
+
+def idct_blocks(coeffs):
+    """IDCT 2 มิติของทุกบล็อกใน (N, 8, 8)"""
+    return _dct_rows_then_cols(coeffs, cv2.DCT_INVERSE)
+
+def _block_rows(coeffs, idx):
+    """index ของบล็อก ให้ broadcast กับ idx ได้ (รองรับ idx แบบ (N,) และ (N, k))"""
+    return np.arange(len(coeffs)).reshape((-1,) + (1,) * (np.ndim(idx) - 1))
+
+def pair_coeffs(coeffs, idx1, idx2):
+    """ค่า (c1, c2) ของคู่สัมประสิทธิ์ในแต่ละบล็อก"""
+    rows = _block_rows(coeffs, idx1)
+    c1 = coeffs[rows, _MID_BAND_U[idx1], _MID_BAND_V[idx1]]
+    c2 = coeffs[rows, _MID_BAND_U[idx2], _MID_BAND_V[idx2]]
+    return c1, c2
+
+def pair_diffs(coeffs, idx1, idx2):
+    """ผลต่าง c1 - c2 ของคู่สัมประสิทธิ์ในแต่ละบล็อก"""
+    c1, c2 = pair_coeffs(coeffs, idx1, idx2)
+    return c1 - c2
+
+def pairwise_shifts(diffs, bits, T):
+    """
+    ขนาดที่ต้องเลื่อน c1/c2 ของแต่ละบล็อก (กฎเดียวกับ embed_dct_pairwise)
+    ค่าบวก = c1 เพิ่ม c2 ลด, ค่าลบ = c1 ลด c2 เพิ่ม
+    """
+    bits = np.asarray(bits)
+    up = np.where(diffs < T, (T - diffs) / 2.0, 0.0)
+    down = np.where(diffs > -T, (T + diffs) / 2.0, 0.0)
+    return np.where(bits == 1, up, -down).astype(np.float32)
+
+def apply_pairwise_shifts(coeffs, idx1, idx2, shifts):
+    """บวก shift เข้าไปที่คู่สัมประสิทธิ์ของแต่ละบล็อก (แก้ coeffs โดยตรง)"""
+    rows = _block_rows(coeffs, idx1)
+    coeffs[rows, _MID_BAND_U[idx1], _MID_BAND_V[idx1]] += shifts
+    coeffs[rows, _MID_BAND_U[idx2], _MID_BAND_V[idx2]] -= shifts
+
+def embed_blocks(blocks, bits, idx1, idx2, T=T):
+    """
+    ฝังบิตลงบล็อก (N, 8, 8) ที่ดึงมาตามลำดับของ key schedule แล้ว คืนบล็อกใหม่แบบ uint8
+    idx1/idx2 แบบ (N,) = บล็อกละบิต, แบบ (N, k) = k บิตต่อบล็อก (บิตที่ j*k ถึง j*k + k - 1 อยู่ในบล็อกที่ j)
+    """
+    bits = np.asarray(bits, dtype=np.uint8)
+    coeffs = dct_blocks(blocks)
+    diffs = pair_diffs(coeffs, idx1, idx2)
+    if diffs.ndim == 1:
+        shifts = pairwise_shifts(diffs, bits, T)
+    else:
+        # บล็อกสุดท้ายอาจมีบิตไม่ครบ k -> คู่ที่เหลือไม่ต้องแตะ
+        padded = np.zeros(diffs.size, dtype=np.uint8)
+        padded[:len(bits)] = bits
+        shifts = pairwise_shifts(diffs, padded.reshape(diffs.shape), T)
+        shifts *= (np.arange(diffs.size) < len(bits)).reshape(diffs.shape)
+    apply_pairwise_shifts(coeffs, idx1, idx2, shifts)
+    return np.clip(idct_blocks(coeffs), 0, 255).astype(np.uint8)
+
 # --- 2. (ใหม่) ฟังก์ชันสำหรับ ECC (Repetition) ---
 def encode_repetition(bits, repeat=3):
     """ขยายบิตโดยการทำซ้ำ เช่น [1,0] -> [1,1,1, 0,0,0]"""
@@ -55,71 +168,23 @@ def embed_dct_pairwise(img, watermark_bits_encoded, key=KEY, T=T):
     if h % BLOCK_SIZE != 0 or w % BLOCK_SIZE != 0:
         raise ValueError("ขนาดภาพต้องหาร 8 ลงตัว (ควร Pad ภาพก่อน)")
 
-    watermarked = np.zeros_like(img, dtype=np.float32)
-    
     nb_h = h // BLOCK_SIZE
     nb_w = w // BLOCK_SIZE
     total_blocks = nb_h * nb_w
     
     # --- ตรรกะการสุ่มลำดับบล็อก (สำคัญมาก) ---
-    rng_master = np.random.RandomState(key)
-    block_ids = np.arange(total_blocks)
-    rng_master.shuffle(block_ids) # สลับลำดับบล็อกที่จะใช้
+    # ลำดับบล็อกและคู่สัมประสิทธิ์มาจาก key_schedule (cache ไว้ต่อ key และขนาดภาพ)
+    n_used = min(len(watermark_bits_encoded), total_blocks)
+    block_ids, pair_idx1, pair_idx2 = key_schedule(total_blocks, n_used, key)
+    bits = np.asarray(watermark_bits_encoded)[:n_used]
     
-    bit_idx = 0
-    
-    # วนลูปตามลำดับบล็อกที่สุ่มแล้ว
-    for b_id in block_ids:
-        if bit_idx >= len(watermark_bits_encoded):
-            break # ฝังครบทุกบิตแล้ว
-            
-        by = b_id // nb_w
-        bx = b_id % nb_w
-        
-        # ดึงบล็อกต้นฉบับ
-        block = img[by*BLOCK_SIZE:(by+1)*BLOCK_SIZE, bx*BLOCK_SIZE:(bx+1)*BLOCK_SIZE]
-        dct_block = cv2.dct(np.float32(block))
-        
-        # --- นี่คือหัวใจของ Pairwise ---
-        
-        # 1. เลือก "คู่" ที่จะใช้ โดยใช้ key + b_id เพื่อให้ deterministic
-        rng_block = np.random.RandomState(key + b_id)
-        idx1 = rng_block.randint(N_MID_BAND)
-        idx2 = (idx1 + 1 + rng_block.randint(N_MID_BAND - 1)) % N_MID_BAND
-        (u1, v1) = MID_BAND[idx1]
-        (u2, v2) = MID_BAND[idx2]
-        
-        c1 = dct_block[u1, v1]
-        c2 = dct_block[u2, v2]
-        diff = c1 - c2
-        
-        bit = watermark_bits_encoded[bit_idx]
-        
-        # 2. บังคับความสัมพันธ์
-        if bit == 1:
-            if diff < T: # ถ้า c1 - c2 ยังไม่มากพอ
-                shift = (T - diff) / 2.0
-                dct_block[u1, v1] += shift
-                dct_block[u2, v2] -= shift
-        else: # bit == 0
-            if diff > -T: # ถ้า c1 - c2 ยังไม่ "ติดลบ" มากพอ
-                shift = (T + diff) / 2.0
-                dct_block[u1, v1] -= shift
-                dct_block[u2, v2] += shift
-        # ---------------------------------
-
-        watermarked[by*BLOCK_SIZE:(by+1)*BLOCK_SIZE, bx*BLOCK_SIZE:(bx+1)*BLOCK_SIZE] = cv2.idct(dct_block)
-        bit_idx += 1
-
-    # คัดลอกบล็อกที่ไม่ได้ใช้ (บล็อกที่เหลือ) จากภาพต้นฉบับ
-    unused_blocks = block_ids[bit_idx:]
-    for b_id in unused_blocks:
-        by = b_id // nb_w
-        bx = b_id % nb_w
-        block = img[by*BLOCK_SIZE:(by+1)*BLOCK_SIZE, bx*BLOCK_SIZE:(bx+1)*BLOCK_SIZE]
-        watermarked[by*BLOCK_SIZE:(by+1)*BLOCK_SIZE, bx*BLOCK_SIZE:(bx+1)*BLOCK_SIZE] = block
-
-    return np.clip(watermarked, 0, 255).astype(np.uint8)
+    # --- นี่คือหัวใจของ Pairwise: DCT ทุกบล็อกที่ใช้พร้อมกัน แล้วบังคับ c1 - c2 ตามบิต ---
+    # บล็อกที่ไม่ได้ใช้ คงค่าเดิมจากภาพต้นฉบับ (ไม่ต้องแปลงทั้งภาพเป็น float)
+    watermarked = np.array(img, dtype=np.uint8)
+    scatter_blocks(watermarked, block_ids,
+                   embed_blocks(gather_blocks(img, block_ids), bits, pair_idx1, pair_idx2, T))
+
+    return watermarked
 
 
 # --- 4. (ผ่าตัดใหม่) ฟังก์ชัน Extract ---
@@ -138,49 +203,308 @@ def extract_dct_pairwise(watermarked, num_bits_encoded, key=KEY):
     total_blocks = nb_h * nb_w
 
     # --- ตรรกะการสุ่มลำดับบล็อก (ต้องเหมือนตอนฝังเป๊ะๆ) ---
+    n_used = min(num_bits_encoded, total_blocks)
+    block_ids, pair_idx1, pair_idx2 = key_schedule(total_blocks, n_used, key)
+
+    # ถ้าสกัดบิตได้ไม่ครบ (เช่น ภาพถูกตัด) ให้เติม 0
+    extracted_bits = np.zeros(num_bits_encoded, dtype=np.uint8)
+    extracted_bits[:n_used] = _extract_scheduled_bits(watermarked, block_ids, pair_idx1, pair_idx2)
+    return extracted_bits
+
+# --- 5. ตรวจสอบแบบ Sequential (SPRT) ---
+# เกณฑ์เดียวกับโหมดสกัดเต็ม: ลายน้ำตรงกันเมื่อ BER หลัง decode_repetition <= 10%
+MATCH_BER = 0.10
+# ครึ่งความกว้างของช่วง "ไม่สนใจ" รอบ agreement ที่เป็นเกณฑ์ (H0/H1 อยู่คนละฝั่งของเกณฑ์)
+SEQ_INDIFFERENCE = 0.05
+
+def _extract_scheduled_bits(watermarked, block_ids, idx1, idx2):
+    """สกัดบิตจากบล็อกที่ระบุ (ลำดับเดียวกับ key_schedule): บิต = 1 เมื่อ c1 - c2 > 0"""
+    coeffs = dct_blocks(gather_blocks(watermarked, block_ids))
+    return (pair_diffs(coeffs, idx1, idx2) > 0).astype(np.uint8)
+
+def repetition_decoded_ber(agreement, repeat=3, ones=0.5):
+    """
+    BER หลัง decode_repetition เมื่อแต่ละบิตที่สกัดได้ตรงกับที่ฝังด้วยโอกาส agreement (อิสระต่อกัน)
+    ones: สัดส่วนบิต 1 ของ payload (repeat คู่ เสมอกันจะ decode เป็น 0)
+    """
+    need = repeat // 2 + 1
+    def at_least(k_min, p):
+        return sum(math.comb(repeat, k) * p ** k * (1.0 - p) ** (repeat - k) for k in range(k_min, repeat + 1))
+    # บิต 1 ผิดเมื่อได้ 1 น้อยกว่า need, บิต 0 ผิดเมื่อได้ 1 ตั้งแต่ need ขึ้นไป
+    return ones * (1.0 - at_least(need, agreement)) + (1.0 - ones) * at_least(need, 1.0 - agreement)
+
+def match_agreement(repeat=3, match_ber=MATCH_BER, ones=0.5):
+    """agreement ต่อบิตต่ำสุดที่ decode_repetition แล้วยังได้ BER <= match_ber (bisection)"""
+    lo, hi = 0.5, 1.0
+    if repetition_decoded_ber(lo, repeat, ones) <= match_ber:
+        return lo
+    for _ in range(50):
+        mid = (lo + hi) / 2.0
+        if repetition_decoded_ber(mid, repeat, ones) <= match_ber:
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+def verify_dct_pairwise_sequential(watermarked, expected_bits_encoded, key=KEY, repetition=3,
+                                   match_ber=MATCH_BER, p_match=None, p_nomatch=None,
+                                   alpha=1e-3, beta=1e-3, chunk_size=64, min_bits=128):
+    """
+    ตรวจสอบลายน้ำด้วย Sequential Probability Ratio Test บน "บิตที่ตรงกัน"
+    สกัดบิตทีละ chunk ตามลำดับสุ่มจาก key (กระจายไปทั่วทุกบิตของ payload และทุกชุดที่ทำซ้ำ)
+    และหยุดทันทีที่ตัดสินได้ แต่ไม่ก่อนใช้ครบ min_bits บิต
+    watermarked: ภาพที่ต้องการตรวจสอบ (ขนาดหาร 8 ลงตัว)
+    expected_bits_encoded: บิตลายน้ำที่คาดหวัง (รวม ECC แล้ว)
+    repetition / match_ber: เกณฑ์เดียวกับโหมดสกัดเต็ม (BER หลัง decode <= match_ber)
+    p_match / p_nomatch: โอกาสที่บิตจะตรงกัน ภายใต้ H1 / H0
+        ถ้าไม่ระบุ ใช้ agreement ที่เป็นเกณฑ์ของ match_ber +/- SEQ_INDIFFERENCE
+    alpha: อัตรา false match ที่ยอมรับได้, beta: อัตรา false non-match
+
+    ถ้าลายน้ำอื่นที่มีสัดส่วน 1 เท่ากันตรงกันโดยบังเอิญได้ถึง H0 (เช่นโลโก้พื้นขาว)
+    SPRT แยกสองสมมติฐานไม่ได้: สกัดครบทุกบิตแล้วตัดสินด้วยเกณฑ์ของโหมดเต็ม (decided=False)
+    """
+    h, w = watermarked.shape
+    if h % BLOCK_SIZE != 0 or w % BLOCK_SIZE != 0:
+        raise ValueError("ขนาดภาพต้องหาร 8 ลงตัว")
+
+    expected = np.asarray(expected_bits_encoded, dtype=np.uint8)
+    total_blocks = (h // BLOCK_SIZE) * (w // BLOCK_SIZE)
+    block_ids, idx1, idx2 = key_schedule(total_blocks, len(expected), key)
+    expected = expected[:len(block_ids)]
+
+    # ลำดับการตรวจสุ่มตาม key: บิตที่อยู่ติดกันใน payload (และชุดที่ทำซ้ำของบิตเดียวกัน) ไม่ถูกตรวจติดกัน
+    order = np.random.RandomState(key).permutation(len(block_ids))
+
+    # ลายน้ำอื่นที่มีสัดส่วน 1 เท่ากัน (q) จะตรงกันโดยบังเอิญ q^2 + (1-q)^2 ของบิต
+    ones = float(expected.mean()) if len(expected) else 0.5
+    chance = ones * ones + (1.0 - ones) ** 2
+    threshold = match_agreement(repetition, match_ber, ones)
+    if p_match is None:
+        p_match = min(threshold + SEQ_INDIFFERENCE, (1.0 + threshold) / 2.0)
+    if p_nomatch is None:
+        p_nomatch = threshold - SEQ_INDIFFERENCE
+    if not 0.0 < p_nomatch < p_match < 1.0:
+        raise ValueError("ต้องมี 0 < p_nomatch < p_match < 1")
+
+    # log-likelihood ratio ต่อบิต (H1 = ลายน้ำตรงกัน, H0 = ไม่ตรง)
+    llr_agree = math.log(p_match / p_nomatch)
+    llr_disagree = math.log((1.0 - p_match) / (1.0 - p_nomatch))
+    if chance < p_nomatch:
+        upper = math.log((1.0 - beta) / alpha)
+        lower = math.log(beta / (1.0 - alpha))
+    else:
+        upper, lower = math.inf, -math.inf
+    extracted = np.zeros(len(expected), dtype=np.uint8)
+
+    llr = 0.0
+    bits_used = 0
+    bit_errors = 0
+    decided = False
+
+    for start in range(0, len(order), chunk_size):
+        part = order[start:start + chunk_size]
+        bits = _extract_scheduled_bits(watermarked, block_ids[part], idx1[part], idx2[part])
+        extracted[part] = bits
+        agree = bits == expected[part]
+        steps = np.where(agree, llr_agree, llr_disagree)
+        path = llr + np.cumsum(steps)
+
+        # ตัดสินได้เมื่อข้ามเส้นและใช้บิตครบ min_bits แล้ว
+        can_stop = start + np.arange(1, len(path) + 1) >= min_bits
+        crossed = np.flatnonzero(((path >= upper) | (path <= lower)) & can_stop)
+        n = crossed[0] + 1 if len(crossed) else len(path)
+
+        llr = float(path[n - 1])
+        bits_used += int(n)
+        bit_errors += int(np.count_nonzero(~agree[:n]))
+        if len(crossed):
+            decided = True
+            break
+
+    is_match = llr > 0
+    if not decided:
+        # ใช้บิตครบแล้ว: ตัดสินด้วยเกณฑ์เดียวกับโหมดสกัดเต็ม
+        payload = decode_repetition(expected, repetition)
+        decoded_ber = np.mean(decode_repetition(extracted, repetition) != payload) if len(payload) else 1.0
+        is_match = bool(decoded_ber <= match_ber)
+
+    # ความมั่นใจ = posterior ของการตัดสินของ SPRT (prior เท่ากัน); ไม่มีถ้าตัดสินด้วยเกณฑ์โหมดเต็ม
+    confidence = 1.0 / (1.0 + math.exp(-abs(llr))) if decided else None
+
+    return {
+        "is_match": is_match,
+        "decided": decided,
+        "confidence": confidence,
+        "bits_used": bits_used,
+        "bit_errors": bit_errors,
+        "llr": llr,
+    }
+
+# --- 6. หลายบิตต่อบล็อก (Multi-bit) ---
+# ใช้คู่สัมประสิทธิ์ที่ไม่ซ้ำกันหลายคู่ในบล็อกเดียว -> DCT/IDCT ครั้งเดียวได้ k บิต
+MAX_BITS_PER_BLOCK = N_MID_BAND // 2
+
+@lru_cache(maxsize=32)
+def key_schedule_multibit(total_blocks, n_blocks, bits_per_block, key=KEY):
+    """
+    เหมือน key_schedule แต่เลือก bits_per_block คู่ที่ไม่ทับกันต่อบล็อก
+    คืน (block_ids, idx1, idx2) โดย idx1/idx2 มีรูป (n_blocks, bits_per_block)
+    """
     rng_master = np.random.RandomState(key)
     block_ids = np.arange(total_blocks)
     rng_master.shuffle(block_ids)
+    # copy เพื่อไม่ให้ cache ถือ permutation ของทุกบล็อกไว้ (view จะอ้างถึง array เต็ม)
+    block_ids = block_ids[:n_blocks].copy()
 
-    extracted_bits = []
-    
-    # วนลูปตามลำดับบล็อกที่สุ่มแล้ว
-    for b_id in block_ids:
-        if len(extracted_bits) >= num_bits_encoded:
-            break # สกัดครบแล้ว
-            
-        by = b_id // nb_w
-        bx = b_id % nb_w
-        
-        block = watermarked[by*BLOCK_SIZE:(by+1)*BLOCK_SIZE, bx*BLOCK_SIZE:(bx+1)*BLOCK_SIZE]
-        dct_block = cv2.dct(np.float32(block))
+    pairs = np.empty((len(block_ids), 2 * bits_per_block), dtype=np.intp)
+    rng_block = np.random.RandomState()
+    for i, b_id in enumerate(block_ids):
+        rng_block.seed(key + b_id)
+        pairs[i] = rng_block.permutation(N_MID_BAND)[:2 * bits_per_block]
 
-        # --- นี่คือหัวใจของการสกัด Pairwise ---
-        
-        # 1. เลือก "คู่" เดิมเป๊ะๆ
-        rng_block = np.random.RandomState(key + b_id)
-        idx1 = rng_block.randint(N_MID_BAND)
-        idx2 = (idx1 + 1 + rng_block.randint(N_MID_BAND - 1)) % N_MID_BAND
-        (u1, v1) = MID_BAND[idx1]
-        (u2, v2) = MID_BAND[idx2]
-        
-        c1 = dct_block[u1, v1]
-        c2 = dct_block[u2, v2]
-        
-        # 2. ตรวจสอบความสัมพันธ์
-        if (c1 - c2) > 0:
-            extracted_bits.append(1)
-        else:
-            extracted_bits.append(0)
-        # ---------------------------------
-        
-    # ถ้าสกัดบิตได้ไม่ครบ (เช่น ภาพถูกตัด) ให้เติม 0
-    if len(extracted_bits) < num_bits_encoded:
-        extracted_bits.extend([0] * (num_bits_encoded - len(extracted_bits)))
+    idx1 = np.ascontiguousarray(pairs[:, 0::2])
+    idx2 = np.ascontiguousarray(pairs[:, 1::2])
+    for arr in (block_ids, idx1, idx2):
+        arr.setflags(write=False)
+    return block_ids, idx1, idx2
+
+def capacity_multibit(shape, bits_per_block=2):
+    """จำนวนบิตสูงสุด (รวม ECC) ที่ฝังได้ในภาพขนาด shape"""
+    if not 1 <= bits_per_block <= MAX_BITS_PER_BLOCK:
+        raise ValueError(f"bits_per_block ต้องอยู่ระหว่าง 1 ถึง {MAX_BITS_PER_BLOCK}")
+    h, w = shape[:2]
+    return (h // BLOCK_SIZE) * (w // BLOCK_SIZE) * bits_per_block
+
+def embed_schedule(total_blocks, n_bits, bits_per_block=1, key=KEY):
+    """
+    key schedule ของการฝัง n_bits บิต (รวม ECC) คืน (block_ids, idx1, idx2) สำหรับ embed_blocks
+    bits_per_block = 1 ใช้ key_schedule (แบบ embed_dct_pairwise) มากกว่านั้นใช้ key_schedule_multibit
+    """
+    if bits_per_block == 1:
+        return key_schedule(total_blocks, min(n_bits, total_blocks), key)
+    return key_schedule_multibit(total_blocks, -(-n_bits // bits_per_block), bits_per_block, key)
+
+def embed_dct_multibit(img, watermark_bits_encoded, key=KEY, T=T, bits_per_block=2):
+    """
+    ฝังบิตลายน้ำ bits_per_block บิตต่อบล็อก (แบบ vectorized)
+    บิตที่ j*k ถึง j*k + k - 1 อยู่ในบล็อกที่ j ของ key schedule
+    """
+    h, w = img.shape
+    if h % BLOCK_SIZE != 0 or w % BLOCK_SIZE != 0:
+        raise ValueError("ขนาดภาพต้องหาร 8 ลงตัว (ควร Pad ภาพก่อน)")
+
+    bits = np.asarray(watermark_bits_encoded, dtype=np.uint8)
+    capacity = capacity_multibit(img.shape, bits_per_block)
+    if len(bits) > capacity:
+        raise ValueError(f"บิตเกินความจุของภาพ ({len(bits)}/{capacity})")
 
-    return np.array(extracted_bits, dtype=np.uint8)
+    total_blocks = (h // BLOCK_SIZE) * (w // BLOCK_SIZE)
+    block_ids, idx1, idx2 = embed_schedule(total_blocks, len(bits), bits_per_block, key)
 
-# --- 5. (ใหม่) ตัวอย่างการใช้งาน ---
+    # บล็อกที่ไม่ได้ใช้ คงค่าเดิมจากภาพต้นฉบับ (ไม่ต้องแปลงทั้งภาพเป็น float)
+    watermarked = np.array(img, dtype=np.uint8)
+    scatter_blocks(watermarked, block_ids, embed_blocks(gather_blocks(img, block_ids), bits, idx1, idx2, T))
+    return watermarked
+
+def extract_dct_multibit(watermarked, num_bits_encoded, key=KEY, bits_per_block=2):
+    """สกัดบิตที่ฝังด้วย embed_dct_multibit (บิตที่เกินความจุของภาพจะเป็น 0)"""
+    h, w = watermarked.shape
+    if h % BLOCK_SIZE != 0 or w % BLOCK_SIZE != 0:
+        raise ValueError("ขนาดภาพต้องหาร 8 ลงตัว")
+    capacity_multibit(watermarked.shape, bits_per_block) # ตรวจช่วงของ bits_per_block
+
+    total_blocks = (h // BLOCK_SIZE) * (w // BLOCK_SIZE)
+    n_blocks = min(-(-num_bits_encoded // bits_per_block), total_blocks)
+    block_ids, idx1, idx2 = key_schedule_multibit(total_blocks, n_blocks, bits_per_block, key)
+
+    coeffs = dct_blocks(gather_blocks(watermarked, block_ids))
+    extracted = (pair_diffs(coeffs, idx1, idx2) > 0).astype(np.uint8).ravel()
+
+    bits = np.zeros(num_bits_encoded, dtype=np.uint8)
+    n = min(len(extracted), num_bits_encoded)
+    bits[:n] = extracted[:n]
+    return bits
+
+# --- 7. หลายภาพขนาดเท่ากันพร้อมกัน (Batch) ---
+# จำนวนบล็อกต่อรอบของ DCT แบบ batch (ให้ข้อมูลอยู่ใน cache ของ CPU)
+BATCH_CHUNK_BLOCKS = 4096
+
+def _batch_schedule(shape, n_bits, key):
+    """
+    รวม key schedule ของทุกภาพใน batch เป็น array เดียว
+    มองทั้ง batch เป็นภาพสูงภาพเดียว (N*H, W): บล็อก b ของภาพ i คือบล็อก i * total_blocks + b
+    n_bits: จำนวนบิตของแต่ละภาพ, key: key เดียวใช้ทุกภาพ หรือ key ต่อภาพ
+    คืน (block_ids, idx1, idx2, counts) โดย counts คือจำนวนบล็อกที่ใช้ของแต่ละภาพ
+    """
+    n, h, w = shape
+    if h % BLOCK_SIZE != 0 or w % BLOCK_SIZE != 0:
+        raise ValueError("ขนาดภาพต้องหาร 8 ลงตัว (ควร Pad ภาพก่อน)")
+    total_blocks = (h // BLOCK_SIZE) * (w // BLOCK_SIZE)
+
+    keys = [key] * n if np.ndim(key) == 0 else list(key)
+    if len(keys) != n:
+        raise ValueError("จำนวน key ต้องเท่ากับจำนวนภาพ")
+
+    schedules = [key_schedule(total_blocks, min(n_bits[i], total_blocks), keys[i]) for i in range(n)]
+    counts = np.array([len(ids) for ids, _, _ in schedules], dtype=np.int64)
+    offsets = np.repeat(np.arange(n, dtype=np.int64) * total_blocks, counts)
+    block_ids, idx1, idx2 = (np.concatenate(parts) for parts in zip(*schedules))
+    return block_ids + offsets, idx1, idx2, counts
+
+def _as_batch(images):
+    images = np.asarray(images, dtype=np.uint8)
+    if images.ndim != 3 or len(images) == 0:
+        raise ValueError("images ต้องเป็น array 3 มิติ (N, H, W) ที่มีอย่างน้อย 1 ภาพ")
+    return images
+
+def embed_batch(images, payloads, key=KEY, T=T):
+    """
+    ฝังลายน้ำลงภาพหลายภาพขนาดเท่ากันในครั้งเดียว ผลลัพธ์ตรงกับ embed_dct_pairwise ทุก pixel
+    images: array (N, H, W) uint8
+    payloads: บิต (รวม ECC แล้ว) ของแต่ละภาพ N ชุด (ยาวไม่เท่ากันได้)
+    key: key เดียวใช้ทุกภาพ หรือ list ของ key ต่อภาพ
+    """
+    images = _as_batch(images)
+    if len(payloads) != len(images):
+        raise ValueError("จำนวน payload ต้องเท่ากับจำนวนภาพ")
+
+    block_ids, idx1, idx2, counts = _batch_schedule(images.shape, [len(p) for p in payloads], key)
+    bits = np.concatenate([np.asarray(p)[:c] for p, c in zip(payloads, counts)])
+
+    n, h, w = images.shape
+    tall = images.reshape(n * h, w)
+    watermarked = tall.copy()
+    # DCT/IDCT บล็อกของทุกภาพรวมกันทีละ chunk; pixel นอกบล็อกที่ใช้ไม่เปลี่ยนจึงไม่ต้องแปลง float
+    for start in range(0, len(block_ids), BATCH_CHUNK_BLOCKS):
+        part = slice(start, start + BATCH_CHUNK_BLOCKS)
+        blocks = embed_blocks(gather_blocks(tall, block_ids[part]), bits[part], idx1[part], idx2[part], T)
+        scatter_blocks(watermarked, block_ids[part], blocks)
+
+    return watermarked.reshape(n, h, w)
+
+def extract_batch(images, num_bits_encoded, key=KEY):
+    """
+    สกัดบิตจากภาพหลายภาพขนาดเท่ากันในครั้งเดียว ผลลัพธ์ตรงกับ extract_dct_pairwise
+    คืน array (N, num_bits_encoded) (บิตที่เกินความจุของภาพจะเป็น 0)
+    """
+    images = _as_batch(images)
+    block_ids, idx1, idx2, counts = _batch_schedule(
+        images.shape, [num_bits_encoded] * len(images), key)
+
+    n, h, w = images.shape
+    tall = images.reshape(n * h, w)
+    extracted = np.empty(len(block_ids), dtype=np.uint8)
+    for start in range(0, len(block_ids), BATCH_CHUNK_BLOCKS):
+        part = slice(start, start + BATCH_CHUNK_BLOCKS)
+        coeffs = dct_blocks(gather_blocks(tall, block_ids[part]))
+        extracted[part] = pair_diffs(coeffs, idx1[part], idx2[part]) > 0
+
+    # ทุกภาพใช้จำนวนบล็อกเท่ากัน จึงจัดเป็นตารางได้ตรงๆ
+    bits = np.zeros((n, num_bits_encoded), dtype=np.uint8)
+    bits[:, :counts[0]] = extracted.reshape(n, -1)
+    return bits
+
+# --- 8. (ใหม่) ตัวอย่างการใช้งาน ---
 if __name__ == '__main__':
     
     # --- 1. เตรียมข้อมูล ---
@@ -227,4 +551,28 @@ if __name__ == '__main__':
     print(f"Original bits:  {original_watermark_bits[:20]}...")
     print(f"Extracted bits: {extracted_bits[:20]}...")
     print(f"Total Bit Errors: {bit_errors} / {len(original_watermark_bits)}")
-    print(f"Bit Error Rate (BER): {ber:.2f}%")
\ No newline at end of file
+    print(f"Bit Error Rate (BER): {ber:.2f}%")
+
+    # --- 7. ตรวจสอบแบบ Sequential (หยุดเร็ว) ---
+    seq = verify_dct_pairwise_sequential(watermarked_image, bits_to_embed, key=KEY)
+    print(f"\n--- Sequential Verify ---")
+    print(f"Match: {seq['is_match']} (decided={seq['decided']}), "
+          f"confidence={seq['confidence']}, bits used={seq['bits_used']}/{len(bits_to_embed)}")
+
+    # ลายน้ำอื่นที่ครึ่งแรกเหมือนกัน (เช่นโลโก้ที่แถวบนเหมือนกัน) ต้องไม่ผ่าน
+    other_bits = original_watermark_bits.copy()
+    other_bits[len(other_bits) // 2:] ^= 1
+    seq_other = verify_dct_pairwise_sequential(
+        watermarked_image, encode_repetition(other_bits, REPETITION), key=KEY)
+    print(f"Other watermark (same first half): Match: {seq_other['is_match']} "
+          f"(decided={seq_other['decided']}), bits used={seq_other['bits_used']}")
+    assert not seq_other["is_match"]
+    # --- 8. หลายบิตต่อบล็อก ---
+    K = 2
+    print(f"\n--- Multi-bit ({K} bits/block) ---")
+    print(f"Capacity: {capacity_multibit(img.shape, K)} bits")
+    watermarked_multi = embed_dct_multibit(img, bits_to_embed, key=KEY, T=T, bits_per_block=K)
+    extracted_multi = extract_dct_multibit(watermarked_multi, len(bits_to_embed), key=KEY, bits_per_block=K)
+    decoded_multi = decode_repetition(extracted_multi, REPETITION)[:len(original_watermark_bits)]
+    print(f"Blocks used: {-(-len(bits_to_embed) // K)}, "
+          f"Bit Errors: {np.sum(original_watermark_bits != decoded_multi)} / {len(original_watermark_bits)}")
@@ -0,0 +1,262 @@
+import math
+
+import cv2
+import numpy as np
+
+from dct_pairwise import BLOCK_SIZE
+
+# --- ค่าคงที่ของ SSIM (Wang et al. 2004) ---
+SSIM_GAUSSIAN_WIN = 11
+SSIM_GAUSSIAN_SIGMA = 1.5
+SSIM_BOX_WIN = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+DATA_RANGE = 255
+SSIM_CHUNK_BLOCKS = 512 # จำนวนบล็อกต่อรอบ ตอนคำนวณเฉพาะบล็อกที่ถูกแก้ (~24 MB ต่อ chunk แบบ Gaussian)
+# ต่อ pixel ของหน้าต่าง แบบเฉพาะบล็อกถูกกว่าแบบทั้งภาพราว 3 เท่า: หน้าต่างรวมเกินนี้ใช้แบบทั้งภาพแทน
+SSIM_FULL_RATIO = 3
+
+
+def _block_grid(shape):
+    """จำนวนบล็อก (แถว, คอลัมน์) ของภาพหลัง pad_to_multiple ซึ่งเป็นตารางที่ block_ids อ้างถึง"""
+    h, w = shape[:2]
+    return -(-h // BLOCK_SIZE), -(-w // BLOCK_SIZE)
+
+
+def _luma(img, color):
+    """ช่อง Y (YCrCb) ของภาพสี BGR หรือของกองบล็อก/หน้าต่างสี (..., H, W, 3); color=False คืน img ตามเดิม"""
+    if not color:
+        return img
+    ycrcb = cv2.cvtColor(np.ascontiguousarray(img).reshape(-1, img.shape[-2], 3), cv2.COLOR_BGR2YCrCb)
+    return ycrcb[..., 0].reshape(img.shape[:-1])
+
+
+def _gather_blocks(img, block_ids):
+    """
+    ดึงบล็อก 8x8 ตาม block_ids ออกมาเป็น array (N, 8, 8) (ภาพสี: (N, 8, 8, 3)) โดยไม่ copy ทั้งภาพ
+    บล็อกที่เต็มดึงผ่าน view แบบ reshape (เหมือน dct_pairwise.gather_blocks)
+    บล็อกที่ขอบขวา/ล่างอาจเลยภาพออกไป: ทำทีละบล็อก และ pixel ที่อยู่นอกภาพเป็น 0
+    """
+    h, w = img.shape[:2]
+    nb_w = _block_grid(img.shape)[1]
+    full_h, full_w = h // BLOCK_SIZE, w // BLOCK_SIZE
+    block_ids = np.asarray(block_ids, dtype=np.intp)
+    by, bx = block_ids // nb_w, block_ids % nb_w
+    full = (by < full_h) & (bx < full_w)
+
+    blocks = np.zeros((len(block_ids), BLOCK_SIZE, BLOCK_SIZE) + img.shape[2:], dtype=img.dtype)
+    view = img[:full_h * BLOCK_SIZE, :full_w * BLOCK_SIZE].reshape(
+        (full_h, BLOCK_SIZE, full_w, BLOCK_SIZE) + img.shape[2:])
+    blocks[full] = view[by[full], :, bx[full], :]
+    for i in np.flatnonzero(~full):
+        part = img[by[i] * BLOCK_SIZE:(by[i] + 1) * BLOCK_SIZE, bx[i] * BLOCK_SIZE:(bx[i] + 1) * BLOCK_SIZE]
+        blocks[i, :part.shape[0], :part.shape[1]] = part
+    return blocks
+
+
+def _reflect(pos, size):
+    """index แบบ BORDER_REFLECT_101 ของตำแหน่ง pos ที่อาจอยู่นอก [0, size)"""
+    period = max(2 * (size - 1), 1)
+    pos = np.abs(pos) % period
+    return np.where(pos >= size, period - pos, pos)
+
+
+def _gather_windows(img, y0, x0, size):
+    """
+    ดึงหน้าต่าง size x size ที่มุมบนซ้าย (y0, x0) ออกมาเป็น array (N, size, size) (ภาพสี: (N, size, size, 3))
+    หน้าต่างที่อยู่ในภาพทั้งหมดดึงผ่าน view แบบ sliding window (copy ทีละแถว ไม่ต้องมี index ทีละ pixel)
+    เฉพาะหน้าต่างที่เลยขอบภาพจึงใช้ index แบบสะท้อน (BORDER_REFLECT_101)
+    """
+    h, w = img.shape[:2]
+    inside = (y0 >= 0) & (y0 <= h - size) & (x0 >= 0) & (x0 <= w - size)
+    windows = np.empty((len(y0), size, size) + img.shape[2:], dtype=img.dtype)
+    if inside.any():
+        s0, s1 = img.strides[:2]
+        view = np.lib.stride_tricks.as_strided(img, (h - size + 1, w - size + 1, size, size) + img.shape[2:],
+                                               (s0, s1, s0, s1) + img.strides[2:], writeable=False)
+        windows[inside] = view[y0[inside], x0[inside]]
+    edge = ~inside
+    if edge.any():
+        offset = np.arange(size)
+        rows = _reflect(y0[edge][:, None] + offset, h)
+        cols = _reflect(x0[edge][:, None] + offset, w)
+        windows[edge] = img[rows[:, :, None], cols[:, None, :]]
+    return windows
+
+
+def _check_shapes(original, distorted):
+    if original.shape != distorted.shape:
+        raise ValueError("ภาพทั้งสองต้องมีขนาดเท่ากัน")
+
+
+def _ssim_kernel(gaussian):
+    """kernel 1 มิติของ filter แบบ separable"""
+    if gaussian:
+        k = cv2.getGaussianKernel(SSIM_GAUSSIAN_WIN, SSIM_GAUSSIAN_SIGMA, cv2.CV_64F)
+        return k.ravel()
+    return np.full(SSIM_BOX_WIN, 1.0 / SSIM_BOX_WIN)
+
+
+def _ssim_from_moments(mu_x, mu_y, xx, yy, xy, data_range):
+    c1 = (SSIM_K1 * data_range) ** 2
+    c2 = (SSIM_K2 * data_range) ** 2
+    var_x = xx - mu_x * mu_x
+    var_y = yy - mu_y * mu_y
+    cov = xy - mu_x * mu_y
+    num = (2 * mu_x * mu_y + c1) * (2 * cov + c2)
+    den = (mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2)
+    return num / den
+
+
+def _ssim_full(original, distorted, kernel, data_range):
+    """SSIM เฉลี่ยของทุก pixel (filter ทั้งภาพ)"""
+    color = original.ndim == 3
+    x = _luma(original, color).astype(np.float64)
+    y = _luma(distorted, color).astype(np.float64)
+
+    def filt(a):
+        return cv2.sepFilter2D(a, cv2.CV_64F, kernel, kernel,
+                               borderType=cv2.BORDER_REFLECT_101)
+
+    ssim_map = _ssim_from_moments(filt(x), filt(y), filt(x * x),
+                                  filt(y * y), filt(x * y), data_range)
+    return float(ssim_map.mean())
+
+
+def psnr(original, distorted, block_ids=None, data_range=DATA_RANGE):
+    """
+    PSNR (dB) แบบ vectorized (ภาพสี BGR วัดบนช่อง Y)
+    block_ids: ถ้าระบุ จะคำนวณ error เฉพาะบล็อกที่ถูกแก้ (บล็อกอื่นถือว่าเหมือนเดิม)
+               เลขบล็อกนับบนตารางของภาพหลัง pad_to_multiple; pixel ของบล็อกที่เลยขอบภาพไม่ถูกนับ
+    """
+    _check_shapes(original, distorted)
+
+    color = original.ndim == 3
+    if block_ids is None:
+        diff = _luma(original, color).astype(np.float64) - _luma(distorted, color)
+    else:
+        # pixel ที่อยู่นอกภาพเป็น 0 ทั้งสองภาพ (ภาพสี: ดำ ซึ่ง Y = 0) จึงไม่ถูกนับ
+        diff = _luma(_gather_blocks(original, block_ids), color).astype(np.float64)
+        diff -= _luma(_gather_blocks(distorted, block_ids), color)
+
+    h, w = original.shape[:2]
+    mse = float(np.vdot(diff, diff)) / (h * w)
+    if mse == 0:
+        return math.inf
+    return 10.0 * math.log10((data_range ** 2) / mse)
+
+
+def ssim(original, distorted, block_ids=None, gaussian=True, data_range=DATA_RANGE):
+    """
+    SSIM เฉลี่ยทั้งภาพ ใช้ filter แบบ separable (Gaussian 11x11 sigma 1.5 หรือ box 7x7) ภาพสี BGR วัดบนช่อง Y
+    ขอบภาพใช้ reflect (BORDER_REFLECT_101) และเฉลี่ยทุก pixel
+    block_ids: ถ้าระบุ จะคำนวณ SSIM map เฉพาะ pixel ที่หน้าต่างแตะบล็อกที่ถูกแก้
+               pixel อื่นมีค่า SSIM = 1 พอดี จึงไม่ต้องคำนวณ
+               เลขบล็อกนับบนตารางของภาพหลัง pad_to_multiple (ภาพไม่ต้องหาร 8 ลงตัว)
+    """
+    _check_shapes(original, distorted)
+    kernel = _ssim_kernel(gaussian)
+
+    if block_ids is None:
+        return _ssim_full(original, distorted, kernel, data_range)
+
+    radius = len(kernel) // 2
+    h, w = original.shape[:2]
+    color = original.ndim == 3
+    nb_h, nb_w = _block_grid(original.shape)
+
+    # pixel ที่ SSIM อาจเปลี่ยน = บล็อกที่ถูกแก้ขยายออกไป radius pixel
+    # (พื้นที่ out x out) ซึ่งต้องใช้ input รอบนอกอีก radius (inp x inp)
+    out = BLOCK_SIZE + 2 * radius
+    inp = BLOCK_SIZE + 4 * radius
+    reach = (2 * radius + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+    # ตารางบล็อกที่ถูกแก้ (ขอบกว้าง reach) ใช้ตัดบล็อกซ้ำ และเรียงบล็อกตามตำแหน่งในภาพไปพร้อมกัน
+    modified = np.zeros((nb_h + 2 * reach, nb_w + 2 * reach), dtype=np.float32)
+    modified[reach:reach + nb_h, reach:reach + nb_w].flat[np.asarray(block_ids, dtype=np.intp)] = 1
+    bys, bxs = np.nonzero(modified)
+    if len(bys) == 0:
+        return 1.0
+    bys -= reach
+    bxs -= reach
+    # บล็อกที่ถูกแก้ครอบภาพเกือบทั้งหมด (เช่นภาพเล็ก): filter ทั้งภาพถูกกว่า
+    if len(bys) * inp * inp > SSIM_FULL_RATIO * h * w:
+        return _ssim_full(original, distorted, kernel, data_range)
+
+    # บล็อกที่ถูกแก้อยู่ใกล้กัน พื้นที่จะซ้อนกัน -> ให้น้ำหนัก 1/จำนวนพื้นที่ที่ครอบ pixel นั้น
+    # overlap[n] คือส่วนที่พื้นที่ของบล็อกที่ห่างไป offsets[n] ทับพื้นที่ของบล็อกเรา
+    steps = range(-reach, reach + 1)
+    offsets = [(dy, dx) for dy in steps for dx in steps if (dy, dx) != (0, 0)]
+    idx = np.arange(out)
+    overlap = np.empty((len(offsets), out * out), dtype=np.float32)
+    for n, (dy, dx) in enumerate(offsets):
+        rows = (idx >= BLOCK_SIZE * dy) & (idx < BLOCK_SIZE * dy + out)
+        cols = (idx >= BLOCK_SIZE * dx) & (idx < BLOCK_SIZE * dx + out)
+        overlap[n] = np.outer(rows, cols).ravel()
+
+    # filter แบบ separable ในหน้าต่าง inp x inp ที่ให้ผลเฉพาะพื้นที่ out x out = k_mat @ tile @ k_mat.T
+    k_mat = np.zeros((out, inp), dtype=np.float32)
+    for i in range(out):
+        k_mat[i, i:i + len(kernel)] = kernel
+    k_mat_t = np.ascontiguousarray(k_mat.T)
+
+    center = np.float32(data_range / 2.0)
+    c1 = np.float32((SSIM_K1 * data_range) ** 2)
+    c2 = np.float32((SSIM_K2 * data_range) ** 2)
+
+    total = 0.0
+    covered = 0.0
+    # ทำทีละ chunk เพื่อไม่ให้ใช้หน่วยความจำตามจำนวนบล็อกทั้งหมด
+    for start in range(0, len(bys), SSIM_CHUNK_BLOCKS):
+        by = bys[start:start + SSIM_CHUNK_BLOCKS]
+        bx = bxs[start:start + SSIM_CHUNK_BLOCKS]
+        n = len(by)
+
+        # คำนวณเป็น float32 ทั้งหมด โดยเลื่อนค่าให้อยู่รอบ 0 ก่อน เพื่อไม่ให้ variance เพี้ยนจากการลบเลขใหญ่
+        # SSIM ใช้แค่ var_x + var_y จึง filter x*x + y*y เป็น plane เดียว (4 plane แทน 5)
+        planes = np.empty((4, n, inp, inp), dtype=np.float32)
+        x, y, sq, xy = planes
+        y0 = by * BLOCK_SIZE - 2 * radius
+        x0 = bx * BLOCK_SIZE - 2 * radius
+        np.subtract(_luma(_gather_windows(original, y0, x0, inp), color), center, out=x, dtype=np.float32)
+        np.subtract(_luma(_gather_windows(distorted, y0, x0, inp), color), center, out=y, dtype=np.float32)
+        np.multiply(x, x, out=sq)
+        np.multiply(y, y, out=xy)
+        sq += xy
+        np.multiply(x, y, out=xy)
+
+        # filter แนวนอนของทุกแถวทุกหน้าต่างเป็น GEMM ก้อนเดียว แล้วจึง filter แนวตั้งทีละหน้าต่าง
+        rows = (planes.reshape(-1, inp) @ k_mat_t).reshape(4 * n, inp, out)
+        mu_x, mu_y, sq, xy = np.matmul(k_mat, rows).reshape(4, n, out * out)
+
+        # moment ที่เลื่อนแล้วให้ variance/covariance ตรงๆ; ค่าเฉลี่ยจริงคือ mu + c
+        var = sq - mu_x * mu_x - mu_y * mu_y
+        cov = xy - mu_x * mu_y
+        mu_x = mu_x + center
+        mu_y = mu_y + center
+        ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)
+                    / ((mu_x * mu_x + mu_y * mu_y + c1) * (var + c2)))
+
+        # น้ำหนักของแต่ละ pixel: 0 ถ้าอยู่นอกภาพ, 1/จำนวนพื้นที่ที่ครอบ ถ้าอยู่ในภาพ
+        neighbours = np.stack([modified[by + reach + dy, bx + reach + dx] for dy, dx in offsets], axis=1)
+        weight = 1.0 / (1.0 + neighbours @ overlap)
+        py = by[:, None] * BLOCK_SIZE - radius + idx
+        px = bx[:, None] * BLOCK_SIZE - radius + idx
+        inside = ((py >= 0) & (py < h))[:, :, None] & ((px >= 0) & (px < w))[:, None, :]
+        weight *= inside.reshape(n, -1)
+
+        total += float((ssim_map * weight).sum(dtype=np.float64))
+        covered += float(weight.sum(dtype=np.float64))
+
+    return (total + h * w - covered) / (h * w)
+
+
+def quality_report(original, distorted, block_ids=None, gaussian=False):
+    """
+    คืน dict ของ PSNR/SSIM สำหรับแนบไปกับผลลัพธ์ของ /embed
+    SSIM ใช้ box 7x7 เป็นค่าเริ่มต้น (หน้าต่างเล็กกว่า Gaussian 11x11 จึงเร็วกว่าราว 2 เท่า) ส่ง gaussian=True ถ้าต้องการแบบ Wang et al.
+    """
+    return {
+        "psnr": psnr(original, distorted, block_ids),
+        "ssim": ssim(original, distorted, block_ids, gaussian),
+    }
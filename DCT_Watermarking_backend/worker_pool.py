@@ -0,0 +1,192 @@
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as TaskTimeout
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from autotune import autotune
+from dct_pairwise import (KEY, T, embed_dct_pairwise, extract_dct_pairwise,
+                          embed_dct_multibit, extract_dct_multibit, embed_blocks,
+                          verify_dct_pairwise_sequential)
+
+TASK_TIMEOUT = 120 # วินาที ต่อหนึ่งงาน
+
+
+# --- ฝั่ง worker (process ที่อยู่ยาว, cache ของ key_schedule จึงอุ่นอยู่ตลอด) ---
+def _embed_task(in_name, out_name, shape, bits, key, strength, bits_per_block):
+    """ฝังลายน้ำจากภาพใน shared memory แล้วเขียนผลลง shared memory อีกก้อน"""
+    in_shm = shared_memory.SharedMemory(name=in_name)
+    out_shm = shared_memory.SharedMemory(name=out_name)
+    try:
+        img = np.ndarray(shape, dtype=np.uint8, buffer=in_shm.buf)
+        out = np.ndarray(shape, dtype=np.uint8, buffer=out_shm.buf)
+        if bits_per_block == 1:
+            out[...] = embed_dct_pairwise(img, bits, key=key, T=strength)
+        else:
+            out[...] = embed_dct_multibit(img, bits, key=key, T=strength, bits_per_block=bits_per_block)
+        del img, out # ต้องปล่อย view ก่อน close
+    finally:
+        in_shm.close()
+        out_shm.close()
+
+
+def _extract_task(in_name, shape, num_bits, key, bits_per_block):
+    """สกัดบิตจากภาพใน shared memory (ผลมีขนาดเล็ก ส่งกลับตรงๆ)"""
+    in_shm = shared_memory.SharedMemory(name=in_name)
+    try:
+        img = np.ndarray(shape, dtype=np.uint8, buffer=in_shm.buf)
+        if bits_per_block == 1:
+            bits = extract_dct_pairwise(img, num_bits, key=key)
+        else:
+            bits = extract_dct_multibit(img, num_bits, key=key, bits_per_block=bits_per_block)
+        del img
+    finally:
+        in_shm.close()
+    return bits
+
+
+def _read_task(in_name, shape, fn, args, kwargs):
+    """เรียก fn(img, *args, **kwargs) กับภาพใน shared memory ที่อ่านอย่างเดียว (autotune, sequential verify, embed_blocks)"""
+    in_shm = shared_memory.SharedMemory(name=in_name)
+    try:
+        img = np.ndarray(shape, dtype=np.uint8, buffer=in_shm.buf)
+        result = fn(img, *args, **kwargs)
+        del img
+    finally:
+        in_shm.close()
+    return result
+
+
+# --- ฝั่ง parent ---
+def _create_segment(nbytes):
+    return shared_memory.SharedMemory(create=True, size=max(int(nbytes), 1))
+
+
+def _release_segment(shm):
+    """close + unlink เสมอ แม้จะยังมี view ค้างอยู่ (unlink ก่อนเพื่อไม่ให้ชื่อรั่ว)"""
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+
+def _to_segment(img):
+    """คัดลอกภาพลง shared memory ก้อนใหม่ (ครั้งเดียว ไม่ต้อง pickle)"""
+    shm = _create_segment(img.nbytes)
+    try:
+        np.ndarray(img.shape, dtype=np.uint8, buffer=shm.buf)[...] = img
+    except BaseException:
+        _release_segment(shm)
+        raise
+    return shm
+
+
+class SharedMemoryPool:
+    """
+    Process pool สำหรับงาน embed/extract ที่ส่งภาพผ่าน multiprocessing.shared_memory
+    parent เป็นเจ้าของทุก segment: สร้างก่อนส่งงาน และ unlink เสมอเมื่องานจบ/ล้มเหลว
+    worker ได้รับแค่ชื่อ segment กับ shape
+    """
+
+    def __init__(self, workers=None, timeout=TASK_TIMEOUT):
+        self._workers = workers
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+        atexit.register(self.close)
+
+    def _new_executor(self):
+        # ใช้ spawn เพราะ fork จาก server ที่มีหลาย thread ไม่ปลอดภัย
+        return ProcessPoolExecutor(
+            max_workers=self._workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def _restart(self, broken):
+        """แทน executor ที่เสีย (worker ตาย เช่น ถูก OOM kill) ด้วยตัวใหม่; thread อื่นอาจสร้างให้แล้ว"""
+        with self._lock:
+            if self._executor is broken:
+                self._executor = self._new_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, fn, *args):
+        """
+        ส่งงานให้ worker แล้วรอผล ถ้า pool เสียจะสร้างใหม่แล้วลองอีกครั้งเดียว
+        งานที่เกิน timeout ถูกยกเลิก (ถ้ายังไม่เริ่ม) ก่อนผู้เรียก unlink segment
+        """
+        for attempt in range(2):
+            executor = self._executor
+            future = None
+            try:
+                future = executor.submit(fn, *args)
+                return future.result(timeout=self._timeout)
+            except BrokenProcessPool:
+                self._restart(executor)
+                if attempt == 1:
+                    raise
+            except TaskTimeout:
+                future.cancel()
+                raise
+
+    def embed(self, img, bits, key=KEY, T=T, bits_per_block=1):
+        """เหมือน embed_dct_pairwise (หรือ embed_dct_multibit ถ้า bits_per_block > 1) แต่ทำใน worker process"""
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        in_shm = _to_segment(img)
+        out_shm = None
+        try:
+            out_shm = _create_segment(img.nbytes)
+            self._run(
+                _embed_task, in_shm.name, out_shm.name, img.shape,
+                np.asarray(bits, dtype=np.uint8), key, T, bits_per_block
+            )
+            return np.ndarray(img.shape, dtype=np.uint8, buffer=out_shm.buf).copy()
+        finally:
+            _release_segment(in_shm)
+            if out_shm is not None:
+                _release_segment(out_shm)
+
+    def _run_read(self, task, img, *args):
+        """ส่งภาพลง segment ใหม่ให้งานที่อ่านอย่างเดียว แล้ว unlink เมื่องานจบ"""
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        in_shm = _to_segment(img)
+        try:
+            return self._run(task, in_shm.name, img.shape, *args)
+        finally:
+            _release_segment(in_shm)
+
+    def extract(self, img, num_bits, key=KEY, bits_per_block=1):
+        """เหมือน extract_dct_pairwise (หรือ extract_dct_multibit ถ้า bits_per_block > 1) แต่ทำใน worker process"""
+        return self._run_read(_extract_task, img, int(num_bits), key, bits_per_block)
+
+    def embed_blocks(self, blocks, bits, idx1, idx2, T=T):
+        """เหมือน dct_pairwise.embed_blocks (บล็อก (N, 8, 8) ของช่อง Y ภาพสี) แต่ทำใน worker process"""
+        args = (np.asarray(bits, dtype=np.uint8), idx1, idx2)
+        return self._run_read(_read_task, blocks, embed_blocks, args, {"T": T})
+
+    def autotune(self, img, payload_bits, key=KEY, **kwargs):
+        """เหมือน autotune.autotune แต่ทำใน worker process"""
+        args = (np.asarray(payload_bits, dtype=np.uint8),)
+        return self._run_read(_read_task, img, autotune, args, dict(kwargs, key=key))
+
+    def verify_sequential(self, img, expected_bits_encoded, key=KEY, **kwargs):
+        """เหมือน verify_dct_pairwise_sequential แต่ทำใน worker process"""
+        args = (np.asarray(expected_bits_encoded, dtype=np.uint8),)
+        return self._run_read(_read_task, img, verify_dct_pairwise_sequential, args, dict(kwargs, key=key))
+
+    def close(self):
+        """ปิด worker ทั้งหมด (เรียกซ้ำได้)"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()